@@ -53,18 +53,12 @@ def ga_hc_experiment(path_results):
         ga_tp, _ = random_walks.generate_ga_tm(ga_length, pmut=1.0/ga_length)
         np.savetxt(tp_path, ga_tp)
 
-    fit_path = os.path.join(path_results, "ga_length_10", "fitness_vals.dat")
-    try:
-        ga_fit = np.genfromtxt(fit_path)
-    except:
-        ga_fit = random_walks.onemax_fitvals(ga_length)
-        np.savetxt(fit_path, ga_fit)
+    ga_fit = random_walks.fitness_vals(os.path.join(path_results, "ga_length_10"))
 
     # just get mu(sigma()), don't bother with sigma(sigma())
     mu_sigma_vals = [random_walks.mu_sigma(random_walks.uniformify(ga_tp, uniformify_val))[0]
                      for uniformify_val in uniformify_vals]
 
-    reps = 30
     steps = 50
     for rep_name, tp, fitvals in [["ga", ga_tp, ga_fit]]:
 
@@ -73,12 +67,12 @@ def ga_hc_experiment(path_results):
             tmp_fit = random_walks.permute_vals(fitvals, noise_val)
 
             for uniformify_val in uniformify_vals:
-                for rep in range(reps):
-                    tp_tmp = random_walks.uniformify(tp, uniformify_val)
-                    samples, fit_samples, best = random_walks.hillclimb(tp_tmp, tmp_fit,
-                                                                        steps, rw=False)
-                    x = best
-                    results[rep_name, uniformify_val, noise_val, rep] = x
+                tp_tmp = random_walks.uniformify(tp, uniformify_val)
+                # exact mean and stddev of the best fitness found,
+                # instead of averaging over repeated hill-climbs (see
+                # random_walks.test_hillclimb_exact for a cross-check)
+                results[rep_name, uniformify_val, noise_val] = \
+                    random_walks.hillclimb_expected_fitness(tp_tmp, tmp_fit, steps)
     return results, mu_sigma_vals
 
 def plot_ga_hc_results(results, mu_sigma_vals, path_results):
@@ -86,17 +80,15 @@ def plot_ga_hc_results(results, mu_sigma_vals, path_results):
     uniformify_vals = [0.1, 0.5, .75, 0.9, 1.0, 1.0/0.9, 1.0/.75, 2.0, 10.0]
     noise_vals = [0, 1, 10, 100, 1000]
 
-    reps = 30
     for rep_name in ["ga"]:
         for noise_val in noise_vals:
             mu = []
             err = []
 
             for uniformify_val in uniformify_vals:
-                x = [results[rep_name, uniformify_val, noise_val, rep]
-                     for rep in range(reps)]
-                mu.append(np.mean(x))
-                err.append(np.std(x))
+                m, e = results[rep_name, uniformify_val, noise_val]
+                mu.append(m)
+                err.append(e)
 
             plt.figure(figsize=(5, 2.5))
             plt.errorbar(mu_sigma_vals, mu, yerr=err, lw=3)
@@ -108,11 +100,9 @@ def plot_ga_hc_results(results, mu_sigma_vals, path_results):
             plt.savefig(filename + ".pdf")
             plt.savefig(filename + ".eps")
 
-def write_ga_fitness_vals(n):
-    ga_fit = onemax_fitvals(n)
-    ga_outfile = open(dirname + "/ga_length_" + str(n) + "/fitness_vals.dat", "w")
-    for fitval in ga_fit:
-        ga_outfile.write(fitval)
+def write_ga_fitness_vals(path_results, n):
+    ga_fit = random_walks.onemax_fitvals(n)
+    np.savetxt(os.path.join(path_results, "ga_length_" + str(n), "fitness_vals.dat"), ga_fit)
 
 def write_gp_trees(path_results):
     n = 2
@@ -146,57 +136,49 @@ def ga_gp_rw_experiment(path_results):
 
     print "doing probability of encounter experiment"
     # Do the "probability of encounter" experiment first
-    reps = 100
     steps = 50
 
-    fit_path = os.path.join(path_results, "ga_length_10", "fitness_vals.dat")
-    ga_fit = np.genfromtxt(fit_path)
-
-    gp_fit = [float(s) for s in
-              open(os.path.join(path_results, "depth_2", "all_fitness_values.dat")).readlines()]
+    # in memory, not memory-mapped, since they're pickled with the results
+    ga_fit = np.array(random_walks.fitness_vals(os.path.join(path_results, "ga_length_10")))
+    gp_fit = random_walks.load_array(os.path.join(path_results, "depth_2", "all_fitness_values.dat"), None)
 
+    # exact probabilities, rather than counting over repeated walks
     inds = 0, len(gp_fit)-1
-    hc_encounters = [0.0, 0.0]
-    rw_encounters = [0.0, 0.0]
-    for rep_name, tp, fitvals in [["gp", gp_tp, gp_fit]]:
-        for rep in range(reps):
-            samples, fit_samples, best = random_walks.hillclimb(gp_tp, fitvals, steps, rw=False)
-            for i in range(2):
-                if inds[i] in samples:
-                    hc_encounters[i] += 1.0 / reps
-            samples, fit_samples, best = random_walks.hillclimb(gp_tp, fitvals, steps, rw=True)
-            for i in range(2):
-                if inds[i] in samples:
-                    rw_encounters[i] += 1.0 / reps
+    hc_encounters = [random_walks.encounter_probability(gp_tp, gp_fit, steps, ind, rw=False)
+                     for ind in inds]
+    rw_encounters = [random_walks.encounter_probability(gp_tp, gp_fit, steps, ind, rw=True)
+                     for ind in inds]
     print "hc_encounters", hc_encounters
     print "rw_encounters", rw_encounters
 
-    # now the GA v GP hillclimb experiments
+    # now the GA v GP hillclimb experiments. The mean proportion of
+    # unique individuals is exact; the stddev still comes from
+    # repeated walks.
     reps = 30
     for rep_name, tp, fitvals in [["ga", ga_tp, ga_fit],
                                   ["gp", gp_tp, gp_fit]]:
         for uniformify_val in uniformify_vals:
+            tp_tmp = random_walks.uniformify(tp, uniformify_val)
+            x = []
             for rep in range(reps):
-                tp_tmp = random_walks.uniformify(tp, uniformify_val)
                 samples, fit_samples, best = random_walks.hillclimb(tp_tmp, fitvals, steps, rw=True)
-                x = float(len(set(samples))) / len(samples)
-                results[rep_name, uniformify_val, rep] = x
+                x.append(float(len(set(samples))) / len(samples))
+            mu = random_walks.expected_distinct_samples(tp_tmp, fitvals, steps, rw=True) / steps
+            results[rep_name, uniformify_val] = mu, np.std(x)
     return results, ga_fit, gp_fit
 
 
 def plot_ga_gp_rw_results(results, mu_sigma_vals, path_results):
     uniformify_vals = [0.1, 0.5, .75, 0.9, 1.0, 1.0/0.9, 1.0/.75, 2.0, 10.0]
 
-    reps = 30
     for rep_name in "ga", "gp":
 
         mu = []
         err = []
         for uniformify_val in uniformify_vals:
-            x = [results[rep_name, uniformify_val, rep]
-                 for rep in range(reps)]
-            mu.append(np.mean(x))
-            err.append(np.std(x))
+            m, e = results[rep_name, uniformify_val]
+            mu.append(m)
+            err.append(e)
 
         plt.figure(figsize=(5, 2.5))
         plt.errorbar(mu_sigma_vals, mu, yerr=err, lw=3)
@@ -245,7 +227,7 @@ def main():
                                            os.path.join(path_results, "depth_2", "all_fitness_values.dat"))
     os.chdir(cwd)
 
-    results_file = os.path.join(path_results, "EuroGP_2014_results.pkl")
+    results_file = os.path.join(path_results, "EuroGP_2014_results_exact.pkl")
     try:
         # restore from a save, if it's been saved
         results = pickle.load(file(results_file))
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+"""This module provides embeddings of distance matrices into a
+low-dimensional space (multi-dimensional scaling), eg for plotting.
+
+As well as sklearn's SMACOF MDS, which needs the whole matrix in
+memory and many iterations, there is classical MDS using a partial
+eigendecomposition, and pivot MDS, which uses only a few columns of
+the matrix. Both of those read the matrix a block of rows at a time,
+so they work on memory-mapped matrices (see
+random_walks.load_array). Results can be cached on disk, keyed by a
+hash of the matrix and the method parameters."""
+
+import numpy as np
+import scipy.sparse.linalg
+import os
+import sys
+import random
+import hashlib
+import multiprocessing
+from random_walks import load_array, array_hash
+
+def classical_mds(D, k=2, blocksize=1024):
+    """Classical (Torgerson) MDS. The embedding is given by the top k
+    eigenvectors of B = -0.5 J D**2 J, where J = I - 11'/n is the
+    centring matrix, each scaled by the square root of its eigenvalue.
+    We only need the top k, so for large n we never form B: eigsh only
+    needs products Bv, which we get by multiplying D**2 by v a block
+    of rows at a time. Negative eigenvalues (which arise when D is not
+    Euclidean) are clipped to zero."""
+    n = len(D)
+
+    if n <= blocksize:
+        # small enough to just do it directly
+        D2 = np.asarray(D, dtype=float)**2
+        B = -0.5 * (D2 - D2.mean(0) - D2.mean(1).reshape((n, 1)) + D2.mean())
+        vals, vecs = np.linalg.eigh(B)
+        vals, vecs = vals[-k:], vecs[:, -k:]
+    else:
+        def matvec(v):
+            v = np.ravel(v)
+            v = v - v.mean()
+            Bv = np.empty(n)
+            for start in range(0, n, blocksize):
+                block = np.asarray(D[start:start+blocksize], dtype=float)
+                Bv[start:start+blocksize] = np.dot(block**2, v)
+            Bv -= Bv.mean()
+            return -0.5 * Bv
+        B = scipy.sparse.linalg.LinearOperator((n, n), matvec=matvec,
+                                               dtype=float)
+        vals, vecs = scipy.sparse.linalg.eigsh(B, k=k, which="LA")
+
+    # largest first
+    order = np.argsort(vals)[::-1]
+    vals = np.maximum(vals[order], 0.0)
+    return vecs[:, order] * np.sqrt(vals)
+
+def maxmin_pivots(D, npivots, seed=None):
+    """Choose npivots rows of D to act as pivots: the first at random,
+    then each subsequent one as far as possible from those already
+    chosen. D is assumed symmetric, so only whole rows are read."""
+    rng = random.Random(seed)
+    pivots = [rng.randrange(len(D))]
+    mindist = np.array(D[pivots[0]], dtype=float)
+    while len(pivots) < npivots:
+        p = int(np.argmax(mindist))
+        pivots.append(p)
+        np.minimum(mindist, D[p], mindist)
+    return pivots
+
+def pivot_mds(D, k=2, npivots=100, seed=0, blocksize=1024):
+    """Pivot MDS (Brandes and Pich, 2007, "Eigensolver methods for
+    progressive multidimensional scaling of large data"). Only the
+    columns of D for a few pivots are used: the n x npivots matrix of
+    squared distances is double-centred to give C, and the embedding
+    is given by the top k left singular vectors u of C. C approximates
+    the pivot columns of B in classical_mds, so C ~ U lam U[pivots]',
+    and each singular value is roughly lam |u[pivots]| for an
+    eigenvalue lam of B. As in classical MDS, each u is scaled by
+    sqrt(lam), not by the singular value, which would distort the
+    axes. This approximates classical MDS in O(n * npivots) memory."""
+    n = len(D)
+    npivots = min(npivots, n)
+    pivots = maxmin_pivots(D, npivots, seed)
+    C = np.empty((n, npivots))
+    for start in range(0, n, blocksize):
+        block = np.asarray(D[start:start+blocksize], dtype=float)
+        C[start:start+blocksize] = block[:, pivots]**2
+    C -= C.mean(0)
+    C -= C.mean(1).reshape((n, 1))
+    C *= -0.5
+    U, s, Vt = np.linalg.svd(C, full_matrices=False)
+    U = U[:, :k]
+    # lam = s / |u restricted to the pivots| (see above)
+    return U * np.sqrt(s[:k] / np.sqrt((U[pivots]**2).sum(0)))
+
+def smacof_mds(D, k=2):
+    """Metric MDS by SMACOF, as implemented in sklearn. Needs the
+    whole of D in memory."""
+    from sklearn.manifold import MDS
+    mds = MDS(n_components=k, dissimilarity="precomputed")
+    return mds.fit(np.asarray(D)).embedding_
+
+methods = {
+    "classical": classical_mds,
+    "pivot": pivot_mds,
+    "smacof": smacof_mds,
+    }
+
+def get_embedding(D, method="classical", cache_dir=None, **params):
+    """Embed the distance matrix D using the given method, passing on
+    any extra parameters (eg k, npivots). If cache_dir is given, look
+    there first for a previous result for the same matrix contents,
+    method and parameters, and save the result there if there isn't
+    one."""
+    if cache_dir is not None:
+        key = hashlib.sha1(array_hash(D) + method
+                           + repr(sorted(params.items()))).hexdigest()
+        filename = os.path.join(cache_dir, method + "_" + key + ".npy")
+        if os.path.exists(filename):
+            return np.load(filename)
+
+    p = methods[method](D, **params)
+
+    if cache_dir is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        np.save(filename, p)
+    return p
+
+def _embed_file(args):
+    filename, method, cache_dir, params = args
+    D = load_array(filename)
+    try:
+        return get_embedding(D, method, cache_dir, **params)
+    except ValueError as e:
+        print("Can't embed " + filename + ": " + str(e))
+        return None
+
+def embed_files(filenames, method="classical", cache_dir=None,
+                nprocs=None, **params):
+    """Embed each of several distance matrices, given by their .dat
+    filenames, in a pool of nprocs worker processes (default one per
+    CPU). Each worker loads its own matrix, memory-mapped. Return a
+    list of embeddings, with None for any which failed."""
+    tasks = [(filename, method, cache_dir, params) for filename in filenames]
+    if nprocs is None:
+        nprocs = multiprocessing.cpu_count()
+    if nprocs == 1 or len(tasks) < 2:
+        return map(_embed_file, tasks)
+    pool = multiprocessing.Pool(min(nprocs, len(tasks)))
+    try:
+        return pool.map(_embed_file, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def test_pivot_mds(n=1500, spreads=(2.93, 0.87), seed=0):
+    """Check pivot_mds and classical_mds against the true
+    configuration, on Euclidean distances between random points."""
+    rng = np.random.RandomState(seed)
+    X = rng.randn(n, len(spreads)) * spreads
+    D = np.sqrt(((X[:, np.newaxis, :] - X[np.newaxis, :, :])**2).sum(2))
+    iu = np.triu_indices(n, 1)
+    for name, p in [("classical", classical_mds(D, len(spreads))),
+                    ("pivot", pivot_mds(D, len(spreads)))]:
+        Dp = np.sqrt(((p[:, np.newaxis, :] - p[np.newaxis, :, :])**2).sum(2))
+        # the best uniform rescaling, then the relative RMS error
+        c = np.dot(Dp[iu], D[iu]) / np.dot(Dp[iu], Dp[iu])
+        err = np.sqrt(np.mean((c * Dp[iu] - D[iu])**2) / np.mean(D[iu]**2))
+        print("%s: axis spreads %s (true %s), scale %.3f, distance error %.2g" % (
+            name, np.round(p.std(0), 2), spreads, c, err))
+
+if __name__ == "__main__":
+    if sys.argv[1] == "test":
+        test_pivot_mds()
+        sys.exit()
+    method = sys.argv[1]
+    filenames = sys.argv[2:]
+    for filename, p in zip(filenames, embed_files(filenames, method)):
+        if p is not None:
+            np.savetxt(os.path.splitext(filename)[0] + "_" + method + ".dat", p)
@@ -6,7 +6,7 @@
 
 __author__  = "Sergio J. Rey <srey@asu.edu> "
 
-__all__=['steady_state','fmpt']
+__all__=['steady_state','fmpt','var_fmpt','first_passage_moments']
 
 import numpy as np
 import numpy.linalg as la
@@ -171,18 +171,80 @@ def var_fmpt(P):
        Chains. Springer-Verlag. Berlin
 
     """
-    A=P**1000
-    n,k=A.shape
-    I=np.identity(k)
-    Z=la.inv(I-P+A)
-    E=np.ones_like(Z)
-    D=np.diag(1./np.diag(A))
-    Zdg=np.diag(np.diag(Z))
-    M=(I-Z+E*Zdg)*D
-    ZM=Z*M
-    ZMdg=np.diag(np.diag(ZM))
-    W=M*(2*Zdg*D-I)+2*(ZM-E*ZMdg)
-    return W-np.multiply(M,M)
+    M, M2 = first_passage_moments(P, 2)
+    return np.matrix(M2 - M * M)
+
+
+def first_passage_moments(P, moments=2):
+    """
+    Raw moments of first passage times for an ergodic transition
+    probability matrix, all from a single matrix inverse.
+
+    Parameters
+    ----------
+
+    P       : array (kxk)
+              an ergodic Markov transition probability matrix
+    moments : int
+              how many moments to return
+
+    Returns
+    -------
+
+    implicit : list of arrays (kxk)
+               the rth array has elements E[T_ij^r], where T_ij is the
+               number of intervals required for a chain starting in
+               state i to first enter state j (the recurrence time if
+               i=j). The first is the same as fmpt.
+
+    Examples
+    --------
+
+    >>> import numpy as np
+    >>> p=np.array([[.5, .25, .25],[.5,0,.5],[.25,.25,.5]])
+    >>> m, m2 = first_passage_moments(p)
+    >>> np.allclose(m, fmpt(np.matrix(p)))
+    True
+    >>> np.allclose(m2 - m * m, var_fmpt(np.matrix(p)))
+    True
+
+    Notes
+    -----
+
+    Conditioning on the first step, X = m^(r) satisfies
+
+        X - P X + P X_dg = R,   R = E + sum_{s<r} C(r,s) P (m^(s) - m^(s)_dg)
+
+    With G = inv(I - P + 1w') for w uniform, the steady state is pi' =
+    w'G, and (I - P) G C = C whenever pi'C = 0. Multiplying the
+    equation by pi' gives the diagonal, X_dg = diag(pi'R) / pi, and
+    then X = G (R - P X_dg) + 1c', with c fixed by the diagonal. So
+    each moment costs two matrix products and no further inverse,
+    rather than the limiting matrix P**1000 of the original var_fmpt.
+    """
+    P=np.asarray(P, dtype=float)
+    k=P.shape[0]
+    w=np.ones(k)/k
+    G=la.inv(np.identity(k)-P+w[np.newaxis,:])
+    pi=np.dot(w,G)
+    result=[]
+    PM=[]
+    binom=[1]
+    for r in range(1, moments+1):
+        # binomial coefficients C(r, s) for s = 0..r
+        binom=[1]+[binom[s-1]+binom[s] for s in range(1, r)]+[1]
+        R=np.ones((k,k))
+        for s in range(1, r):
+            R+=binom[s]*PM[s-1]
+        xdg=np.dot(pi,R)/pi
+        B=np.dot(G,R-P*xdg[np.newaxis,:])
+        X=B+(xdg-np.diag(B))[np.newaxis,:]
+        result.append(X)
+        if r<moments:
+            Xoff=X.copy()
+            np.fill_diagonal(Xoff,0.0)
+            PM.append(np.dot(P,Xoff))
+    return result
 
 
 def _test():
@@ -1,82 +1,331 @@
 #!/usr/bin/env python
 
 import sys
+import os
+import time
+import random
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from itertools import product
 from collections import OrderedDict
 import numpy as np
 from numpy import add, subtract, multiply, divide, sin, cos, exp, log, power, square, sqrt
 np.seterr(all='raise')
 
+############################################################
+# Integer-coded trees
+#
+# A coded tree is a prefix-order array of int8 codes, which index a
+# symbol table shared by every tree in the language. encode_tree and
+# decode_tree convert to and from strings and nested lists. Shapes
+# are counted from their codes, and compile_tree accepts coded trees.
+# The enumerators below work on strings or nested lists directly.
+############################################################
+
+class Symbols(object):
+    """The symbol table of a language: the vars and then the fns. A
+    symbol's code is its index in names."""
+    __slots__ = ("names", "arities", "codes", "nvars", "key")
+
+    def __init__(self, vars, fns):
+        self.names = list(vars) + list(fns)
+        if len(self.names) > 127:
+            raise ValueError("Too many symbols for int8 codes")
+        self.arities = np.array([0] * len(vars) + [fns[fn] for fn in fns], dtype=np.int8)
+        self.codes = dict((name, i) for i, name in enumerate(self.names))
+        self.nvars = len(vars)
+        self.key = (tuple(vars), tuple(fns.items()))
+
+_symbols = {}
+def get_symbols(vars, fns):
+    """The shared Symbols for a language."""
+    key = (tuple(vars), tuple(fns.items()))
+    if key not in _symbols:
+        _symbols[key] = Symbols(vars, fns)
+    return _symbols[key]
+
+class Tree(object):
+    """A coded tree: an int8 array of codes in prefix order, the
+    symbol table they index, and the depth, if known."""
+    __slots__ = ("codes", "symbols", "depth")
+
+    def __init__(self, codes, symbols, depth=None):
+        self.codes = codes
+        self.symbols = symbols
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __str__(self):
+        return decode_tree(self.codes, self.symbols)
+
+    def __repr__(self):
+        return "Tree(%s)" % str(self)
+
+def encode_tree(t, symbols):
+    """Convert a tree string or nested list to a coded Tree."""
+    if isinstance(t, str):
+        t = parse_tree(t) if t.startswith("(") else t
+    codes = []
+    def encode(t):
+        if isinstance(t, str):
+            codes.append(symbols.codes[t])
+        else:
+            codes.append(symbols.codes[t[0]])
+            for child in t[1:]:
+                encode(child)
+    encode(t)
+    return Tree(np.array(codes, dtype=np.int8), symbols)
+
+def decode_tree(codes, symbols, as_string=True):
+    """Convert an array of codes to a string, eg (* x0 x1), or a
+    nested list, eg ['*', 'x0', 'x1']."""
+    # plain lists: indexing an int8 array one element at a time is slow
+    names = symbols.names
+    arities = symbols.arities.tolist()
+    codes = codes.tolist()
+    def decode(i):
+        name = names[codes[i]]
+        a = arities[codes[i]]
+        i += 1
+        if a == 0:
+            return name, i
+        children = []
+        for k in range(a):
+            child, i = decode(i)
+            children.append(child)
+        if as_string:
+            return "(" + name + " " + " ".join(children) + ")", i
+        else:
+            return [name] + children, i
+    return decode(0)[0]
+
 def trees_of_depth(n, vars, fns, as_string=True):
     """Generate all trees of exactly depth n, along with their
     depths."""
-    if n == 0:
-        for item in vars:
-            yield item, 0
-    else:
-        for fn in fns:
-            for children in product(
-                trees_of_depth_LE(n-1, vars, fns, as_string), repeat=fns[fn]):
-                if any(child[1] == n-1 for child in children):
-                    if as_string:
-                        yield ("(" + fn + " "
-                               + " ".join(child[0] for child in children)
-                               + ")"), n
-                    else:
-                        yield [fn] + [child[0] for child in children], n
+    for t, d in trees_of_depth_LE(n, vars, fns, as_string):
+        if d == n:
+            yield t, d
 
 def trees_of_depth_LE(n, vars, fns, as_string=True):
     """Generate all trees up to and including depth n, along with
-    their depths."""
-    for d in range(n+1):
-        for item, d1 in trees_of_depth(d, vars, fns, as_string):
-            yield item, d1
+    their depths. Each tree is built from the strings or nested lists
+    of its already-built children: the trees of depth < n are kept to
+    build the deeper ones from. As in semantics_blocks, the last child
+    is drawn from all trees of depth <= d-1 if an earlier child
+    already has depth d-1, and otherwise only from those of depth
+    d-1."""
+    symbols = get_symbols(vars, fns)
+    names = symbols.names
+    arities = symbols.arities.tolist()
+    prev = names[:symbols.nvars]
+    for t in prev:
+        yield t, 0
+    deep = 0
+    for d in range(1, n+1):
+        new = []
+        for f in range(symbols.nvars, len(names)):
+            name = names[f]
+            for lead in product(range(len(prev)), repeat=arities[f]-1):
+                lead_trees = [prev[i] for i in lead]
+                first = 0 if any(i >= deep for i in lead) else deep
+                if as_string:
+                    prefix = "(" + name + " " + "".join(c + " " for c in lead_trees)
+                for i in range(first, len(prev)):
+                    if as_string:
+                        t = prefix + prev[i] + ")"
+                    else:
+                        t = [name] + lead_trees + [prev[i]]
+                    if d < n:
+                        new.append(t)
+                    yield t, d
+        deep = len(prev)
+        prev = prev + new
+
+# Tree counts, memoised per language. For each (vars, fns) we keep
+# exact[d], the number of trees of depth exactly d, and LE[d], the
+# number of depth <= d. They're Python ints, so they're exact however
+# big they get.
+_counts = {}
+
+def _count_tables(n, vars, fns):
+    """Return (exact, LE), lists of counts up to at least depth n."""
+    key = (tuple(vars), tuple(fns.items()))
+    if key not in _counts:
+        _counts[key] = ([len(vars)], [len(vars)])
+    exact, LE = _counts[key]
+    while len(exact) <= n:
+        d = len(exact)
+        # a tree of depth d is a function whose children all have
+        # depth <= d-1, but not all of them depth <= d-2.
+        A = LE[d-1]
+        B = LE[d-2] if d >= 2 else 0
+        c = sum(A ** fns[fn] - B ** fns[fn] for fn in fns)
+        exact.append(c)
+        LE.append(LE[-1] + c)
+    return exact, LE
 
 def count_trees_of_depth_LE(n, vars, fns):
     """Count the number of trees of depth less than or equal to n."""
-    return sum(count_trees_of_depth(i, vars, fns)
-               for i in range(n+1))
+    return _count_tables(n, vars, fns)[1][n]
 
 def count_trees_of_depth(n, vars, fns):
     """Count the trees of depth exactly n."""
-    if n == 0:
-        return len(vars)
-    else:
-        # there are len(fns.keys()) ways to choose the root
+    return _count_tables(n, vars, fns)[0][n]
 
-        # then you can choose trees of depth n-1 for *both* subtrees.
-        # that gives count_trees_of_depth(n-1) ** 2
+# Ranking and unranking. The index of a tree is its position in
+# trees_of_depth_LE (which is also the order of AllTrees on the Java
+# side). Trees are ordered by depth, then by function in the order of
+# fns, then lexicographically by the indices of their children. The
+# indices of the depth-(d-1) trees are the last ones below LE[d-1],
+# and a tree of depth d needs at least one child among them. The
+# count of such child tuples follows from how many choices remain
+# once the first child is fixed.
 
-        # otherwise, you must choose a left subtree of depth n-1, and
-        # a right subtree of any depth less than that. that gives the
-        # sum of count_trees_of_depth(n-1) * count_trees_of_depth(m),
-        # with m ranging from 0 up to n-2 inclusive.
+def _children_of_rank(r, arity, A, B, constrained):
+    """Unrank r among the arity-tuples of child indices < A, in
+    lexicographic order. If constrained, only tuples with at least one
+    index >= B (a deep child) are counted."""
+    children = []
+    while arity:
+        arity -= 1
+        free = A ** arity
+        if constrained:
+            # a shallow first child leaves the rest constrained
+            rest = free - B ** arity
+            if r < B * rest:
+                children.append(r // rest)
+                r %= rest
+                continue
+            r -= B * rest
+            children.append(B + r // free)
+            r %= free
+            constrained = False
+        else:
+            children.append(r // free)
+            r %= free
+    return children
+
+def _rank_of_children(children, A, B):
+    """Inverse of _children_of_rank with constrained=True."""
+    r = 0
+    constrained = True
+    arity = len(children)
+    for c in children:
+        arity -= 1
+        free = A ** arity
+        if constrained:
+            rest = free - B ** arity
+            if c < B:
+                r += c * rest
+            else:
+                r += B * rest + (c - B) * free
+                constrained = False
+        else:
+            r += c * free
+    return r
+
+def unrank_tree(i, vars, fns, as_string=True):
+    """Return the tree with index i in trees_of_depth_LE order, and its
+    depth, without enumerating the trees before it."""
+    d = 0
+    exact, LE = _count_tables(d, vars, fns)
+    while LE[d] <= i:
+        d += 1
+        exact, LE = _count_tables(d, vars, fns)
+    if d == 0:
+        return vars[i], 0
+    r = i - LE[d-1]
+    A = LE[d-1]
+    B = LE[d-2] if d >= 2 else 0
+    for fn in fns:
+        a = fns[fn]
+        c = A ** a - B ** a
+        if r < c:
+            break
+        r -= c
+    children = [unrank_tree(j, vars, fns, as_string)[0]
+                for j in _children_of_rank(r, a, A, B, True)]
+    if as_string:
+        return "(" + fn + " " + " ".join(children) + ")", d
+    else:
+        return [fn] + children, d
+
+def rank_tree(t, vars, fns):
+    """Return the index of tree t (a string or a nested list) in
+    trees_of_depth_LE order, and its depth. Inverse of unrank_tree."""
+    if isinstance(t, str) and t.startswith("("):
+        t = parse_tree(t)
+    if isinstance(t, str):
+        return list(vars).index(t), 0
+    ranks, depths = zip(*[rank_tree(c, vars, fns) for c in t[1:]])
+    d = 1 + max(depths)
+    exact, LE = _count_tables(d, vars, fns)
+    A = LE[d-1]
+    B = LE[d-2] if d >= 2 else 0
+    i = LE[d-1]
+    for fn in fns:
+        if fn == t[0]:
+            break
+        i += A ** fns[fn] - B ** fns[fn]
+    if fns.get(t[0]) != len(ranks):
+        raise ValueError("Bad function or arity: " + str(t[0]))
+    return i + _rank_of_children(ranks, A, B), d
 
-        # or you can do vice versa (right subtree of depth n-1, left
-        # subtree of any depth less than that). so multiply previous
-        # quantity by 2.
-        return len(fns.keys()) * (
-            count_trees_of_depth(n-1, vars, fns) **
-            2 + sum(2 * count_trees_of_depth(n-1, vars, fns)
-                    * count_trees_of_depth(m, vars, fns)
-                    for m in range(n-1)))
+# Shapes are trees in a language with one variable and one binary
+# function.
+shape_symbols = get_symbols(["x"], OrderedDict([("*", 2)]))
 
 def count_trees_of_given_shape(t, vars, fns):
-    """Tree t is a string, eg (* (+ x y) y). This has n = 2 internal
-    nodes, m = 3 leaves. Number of trees of the same shape will be
-    4^n2^m (if there are 4 possibilities for internal nodes and 2 for
-    leaves)."""
-    def noccurrences(s1, s2):
-        """How many times do items in s2 occur in s1?"""
-        return sum(s1.count(a) for a in s2)
-    internal = vars
-    external = "".join(fns.keys())
-    n = noccurrences(t, internal)
-    m = noccurrences(t, external)
-    return (len(internal)**n) * (len(external)**m)
+    """Tree t is a shape, eg (* (* x x) x), as a string or a coded
+    Tree. This has n = 2 internal nodes, m = 3 leaves. Number of trees
+    of the same shape will be 4^n2^m (if there are 4 possibilities for
+    internal nodes and 2 for leaves). More generally each internal
+    node can be any function of its arity."""
+    if not isinstance(t, Tree):
+        t = encode_tree(t, shape_symbols)
+    node_arities = np.bincount(t.symbols.arities[t.codes])
+    fn_arities = np.bincount(list(fns.values()), minlength=len(node_arities))
+    result = len(vars) ** int(node_arities[0])
+    for a in range(1, len(node_arities)):
+        if node_arities[a]:
+            result *= int(fn_arities[a]) ** int(node_arities[a])
+    return result
 
 def shapes_of_depth_LE(n):
-    for t in trees_of_depth_LE(n, "x", {"*": 2}): yield t
+    """Generate all tree shapes of depth <= n, as strings such as
+    (* (* x x) x), with their depths."""
+    return trees_of_depth_LE(n, shape_symbols.names[:1],
+                             OrderedDict([("*", 2)]))
+
+def sample_trees(k, n, vars, fns, unique=False, as_string=True, rng=random):
+    """Generate k trees, with their depths, drawn uniformly at random
+    from all trees of depth <= n. This draws an index and unranks it,
+    so it works for spaces far too large to enumerate. If unique, no
+    tree is drawn twice."""
+    N = count_trees_of_depth_LE(n, vars, fns)
+    if unique and k > N:
+        raise ValueError("Can't draw %d unique trees from %d" % (k, N))
+    seen = set()
+    while k:
+        i = rng.randrange(N)
+        if unique:
+            if i in seen:
+                continue
+            seen.add(i)
+        k -= 1
+        yield unrank_tree(i, vars, fns, as_string)
+
+def write_sample(k, n, vars, fns, dirname, unique=True):
+    """Write k trees sampled uniformly from depth <= n to
+    dirname/all_trees.dat, one per line, as the Java code does."""
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    outfile = open(os.path.join(dirname, "all_trees.dat"), "w")
+    for t, d in sample_trees(k, n, vars, fns, unique):
+        outfile.write(t + "\n")
+    outfile.close()
 
 # AQ is the analytic quotient from: Ji Ni and Russ H. Drieberg and
 # Peter I. Rockett, "The Use of an Analytic Quotient Operator in
@@ -85,15 +334,22 @@ def AQ(x, y):
     return x/sqrt(1.0+y*y)
 
 def semantics(X, t):
-    """Calculate a vector of yhat values at points X given a tree t."""
-    f = tree_to_fn(t)
-    return f(X)
+    """Calculate a vector of yhat values at points X given a tree t
+    (a string, a nested list or a coded Tree)."""
+    return run_program(compile_tree(t), X)
     
+_pagie_hogeweg_X = None
 def pagie_hogeweg_X():
-    x = np.linspace(-5.0, 5.0, 26)
-    X = np.meshgrid(x, x)
-    X = np.array([X[0].ravel(), X[1].ravel()])
-    return X
+    """The fitness cases, as a 2 x 676 array. It's built once and
+    then shared, so it's read-only."""
+    global _pagie_hogeweg_X
+    if _pagie_hogeweg_X is None:
+        x = np.linspace(-5.0, 5.0, 26)
+        X = np.meshgrid(x, x)
+        X = np.array([X[0].ravel(), X[1].ravel()])
+        X.flags.writeable = False
+        _pagie_hogeweg_X = X
+    return _pagie_hogeweg_X
 
 def pagie_hogeweg_fn(X):
     return 1.0 / (1.0 + X[0]**-4.0) + 1.0 / (1.0 + X[1]**-4.0)
@@ -101,12 +357,50 @@ def pagie_hogeweg_fn(X):
 def another_target_fn(X):
     return 1.0 + X[0]**2.0
     
+_target_vals = {}
+def target_values(target, X=None):
+    """The values of a target function (or a list of them) at the
+    fitness cases, memoised per function. For a list the result is a
+    2-D array, one row per target."""
+    if X is None:
+        X = pagie_hogeweg_X()
+    if isinstance(target, (list, tuple)):
+        return np.array([target_values(f, X) for f in target])
+    key = (target, id(X))
+    if key not in _target_vals:
+        vals = target(X)
+        vals.flags.writeable = False
+        _target_vals[key] = vals
+    return _target_vals[key]
+
+def fitness_of_semantics(sem, target_vals, chunksize=4096):
+    """RMSE of each row of sem (one semantics vector per tree) against
+    target_vals. If target_vals is 2-D (one row per target) the result
+    has one column per target, so several problems are scored in the
+    same pass. Rows are done a chunk at a time to bound the size of
+    the temporary differences."""
+    sem = np.asarray(sem)
+    target_vals = np.asarray(target_vals)
+    single_tree = sem.ndim == 1
+    single_target = target_vals.ndim == 1
+    sem = np.atleast_2d(sem)
+    tv = np.atleast_2d(target_vals)
+    result = np.empty((sem.shape[0], tv.shape[0]))
+    for start in range(0, sem.shape[0], chunksize):
+        chunk = sem[start:start+chunksize]
+        for k in range(tv.shape[0]):
+            diff = chunk - tv[k]
+            result[start:start+chunksize, k] = np.sqrt(np.einsum("ij,ij->i", diff, diff) / tv.shape[1])
+    if single_target:
+        result = result[:, 0]
+    if single_tree:
+        result = result[0]
+    return result
+
 def fitness(t, target):
     """Calculate fitness of a tree t on the given problem"""
     X = pagie_hogeweg_X()
-    t_vals = semantics(X, t)
-    target_vals = target(X)
-    return np.sqrt(np.mean((target_vals - t_vals)**2))
+    return fitness_of_semantics(semantics(X, t), target_values(target, X))
     
 def tree_to_fn(t):
     """Convert a tree t to a runnable function."""
@@ -127,32 +421,405 @@ def tree_to_fn(t):
         f = lambda X: op(*(tree_to_fn(ti)(X) for ti in t[1:]))
     return f
 
+############################################################
+# Compiled evaluation
+#
+# tree_to_fn() rebuilds a tree of closures (and evals the leaves) every
+# time a tree is evaluated. Instead we compile each tree once into a
+# linear postfix program, and run that over X using a preallocated
+# stack of buffers, with the functions applied in place.
+############################################################
+
+# Postfix instructions are (opcode, argument) pairs.
+VAR, CONST, FN = 0, 1, 2
+
+def _aq_inplace(x, y):
+    # AQ(x, y) = x / sqrt(1 + y*y), computed into x, using y as
+    # scratch space
+    np.multiply(y, y, out=y)
+    y += 1.0
+    np.sqrt(y, out=y)
+    np.divide(x, y, out=x)
+
+# In-place versions of the function set: each computes f(x, y) into x.
+inplace_fns = {
+    "+": lambda x, y: np.add(x, y, out=x),
+    "-": lambda x, y: np.subtract(x, y, out=x),
+    "*": lambda x, y: np.multiply(x, y, out=x),
+    "/": _aq_inplace,
+    "AQ": _aq_inplace,
+    }
+
+def parse_tree(s):
+    """Convert a tree string, eg (* (+ x0 x1) x1), to a nested list,
+    eg ['*', ['+', 'x0', 'x1'], 'x1']. A leaf is returned as is."""
+    tokens = s.replace("(", " ( ").replace(")", " ) ").split()
+    def parse(i):
+        if tokens[i] == "(":
+            t = [tokens[i+1]]
+            i += 2
+            while tokens[i] != ")":
+                child, i = parse(i)
+                t.append(child)
+            return t, i + 1
+        else:
+            return tokens[i], i + 1
+    t, i = parse(0)
+    if i != len(tokens):
+        raise ValueError("Unexpected trailing text in tree " + s)
+    return t
+
+def tree_to_string(t):
+    """Convert a nested-list tree to the string form produced by
+    trees_of_depth(as_string=True)."""
+    if isinstance(t, str):
+        return t
+    return "(" + str(t[0]) + " " + " ".join(tree_to_string(ti) for ti in t[1:]) + ")"
+
+def _compile(t):
+    """Compile a nested-list tree to a postfix program. Return the
+    program and the stack depth it needs."""
+    if isinstance(t, str):
+        # as in tree_to_fn: a variable, or else a constant
+        if t == "x" or t == "x0":
+            return [(VAR, 0)], 1
+        elif t == "y" or t == "x1":
+            return [(VAR, 1)], 1
+        else:
+            return [(CONST, float(t))], 1
+    op = str(t[0])
+    if op not in inplace_fns or len(t) != 3:
+        raise ValueError("Can't compile function " + op)
+    program = []
+    depth = 0
+    for i, ti in enumerate(t[1:]):
+        p, d = _compile(ti)
+        program.extend(p)
+        # the ith child's program runs with i values already on the
+        # stack
+        depth = max(depth, i + d)
+    program.append((FN, inplace_fns[op]))
+    return program, depth
+
+def _compile_codes(codes, symbols, i=0):
+    """As _compile, for the subtree starting at codes[i] of a coded
+    tree. Also return the index just past the subtree."""
+    name = symbols.names[codes[i]]
+    if symbols.arities[codes[i]] == 0:
+        program, depth = _compile(name)
+        return program, depth, i + 1
+    if name not in inplace_fns or symbols.arities[codes[i]] != 2:
+        raise ValueError("Can't compile function " + name)
+    program = []
+    depth = 0
+    i += 1
+    for k in range(2):
+        p, d, i = _compile_codes(codes, symbols, i)
+        program.extend(p)
+        depth = max(depth, k + d)
+    program.append((FN, inplace_fns[name]))
+    return program, depth, i
+
+# Compiled programs, keyed by tree string (or by symbol table and
+# codes for a coded Tree), least recently used first.
+_compiled = OrderedDict()
+compiled_cache_size = 100000
+
+def compile_tree(t):
+    """Compile tree t (a string, a nested list or a coded Tree) into a
+    postfix program (see run_program). Programs are kept in an LRU
+    cache."""
+    if isinstance(t, Tree):
+        key = (t.symbols.key, t.codes.tostring())
+    else:
+        key = tree_to_string(t)
+    try:
+        program = _compiled.pop(key)
+    except KeyError:
+        if isinstance(t, Tree):
+            program = _compile_codes(t.codes, t.symbols)[:2]
+        else:
+            if isinstance(t, str):
+                t = parse_tree(t)
+            program = _compile(t)
+    _compiled[key] = program
+    if len(_compiled) > compiled_cache_size:
+        _compiled.popitem(last=False)
+    return program
+
+# The stack of buffers used by run_program, reallocated only when a
+# deeper program or a different number of points comes along.
+_stack = np.empty((0, 0))
+
+def run_program(program, X):
+    """Run a compiled program (see compile_tree) on points X and return
+    the vector of outputs."""
+    global _stack
+    program, depth = program
+    npoints = X.shape[1]
+    if _stack.shape[0] < depth or _stack.shape[1] != npoints:
+        _stack = np.empty((max(depth, _stack.shape[0]), npoints))
+    stack = _stack
+    sp = 0
+    for op, arg in program:
+        if op == VAR:
+            stack[sp] = X[arg]
+            sp += 1
+        elif op == CONST:
+            stack[sp].fill(arg)
+            sp += 1
+        else:
+            sp -= 1
+            arg(stack[sp-1], stack[sp])
+    return stack[0].copy()
+
+def benchmark_evaluators(n, vars, fns, ntrees=10000):
+    """Compare the time taken by tree_to_fn() and by the compiled
+    evaluator to calculate semantics for the first ntrees trees of
+    depth <= d, for d up to n, and check they agree. The compiled
+    evaluator is timed with a cold cache (including compilation) and
+    a warm one."""
+    global _compiled
+    X = pagie_hogeweg_X()
+    for d in range(1, n+1):
+        trees = []
+        for t, depth in trees_of_depth_LE(d, vars, fns, False):
+            trees.append(t)
+            if len(trees) == ntrees:
+                break
+
+        start = time.time()
+        old = [tree_to_fn(t)(X) for t in trees]
+        t_old = time.time() - start
+
+        _compiled = OrderedDict()
+        start = time.time()
+        new = [semantics(X, t) for t in trees]
+        t_cold = time.time() - start
+        start = time.time()
+        new = [semantics(X, t) for t in trees]
+        t_warm = time.time() - start
+
+        agree = all(np.allclose(a, b) for a, b in zip(old, new))
+        print("depth <= %d, %d trees: tree_to_fn %.3fs, compiled (cold) %.3fs, "
+              "compiled (warm) %.3fs, agree: %s"
+              % (d, len(trees), t_old, t_cold, t_warm, agree))
+
+# Out-of-place versions of the function set, which broadcast, so one
+# call can combine one subtree's semantics with a whole block of
+# others.
+fn_impls = {"+": add, "-": subtract, "*": multiply, "/": AQ, "AQ": AQ}
+
+def semantics_blocks(n, vars, fns, X, start=0):
+    """Generate the semantics of all trees of depth <= n, in the same
+    order as trees_of_depth_LE, as a sequence of (depth, block)
+    pairs. Each block is a 2-D array with one row per tree.
+
+    This is dynamic programming: the semantics of every tree of depth
+    < n are kept in one array, sem, indexed by enumeration order.
+    Every tree of depth d is fn(sem[i], sem[j], ...) for some children
+    i, j, ... of depth <= d-1, at least one of them of depth exactly
+    d-1. So for each choice of function and of all children but the
+    last, the semantics of the trees for every possible last child are
+    calculated in one NumPy operation. The depth-n trees are not
+    stored, so they can be consumed a block at a time even when there
+    are millions of them.
+
+    If start is given, the first start trees are skipped, and the
+    depth-n blocks which fall entirely before start aren't
+    calculated, which is what makes resuming cheap."""
+    sem = np.array([semantics(X, v) for v in vars])
+    depths = np.zeros(len(vars), dtype=int)
+    pos = 0
+    if start < len(sem):
+        yield 0, sem[start:]
+    pos += len(sem)
+    for d in range(1, n+1):
+        # trees of depth exactly d-1 are at the end of sem
+        deep = np.searchsorted(depths, d-1)
+        new = []
+        for fn in fns:
+            f = fn_impls[fn]
+            for lead in product(range(len(sem)), repeat=fns[fn]-1):
+                if any(depths[i] == d-1 for i in lead):
+                    last = sem
+                else:
+                    last = sem[deep:]
+                if d == n and pos + len(last) <= start:
+                    pos += len(last)
+                    continue
+                block = f(*([sem[i] for i in lead] + [last]))
+                if pos + len(block) > start:
+                    yield d, block[max(start - pos, 0):]
+                pos += len(block)
+                if d < n:
+                    new.append(block)
+        if d < n:
+            sem = np.vstack([sem] + new)
+            depths = np.concatenate([depths, d * np.ones(len(sem) - len(depths), dtype=int)])
+
 def enumerate_fitness_and_semantics(n, vars, fns, target=pagie_hogeweg_fn):
     """For all trees of depth <= n with given alphabet, calculate
-    their semantics vector and fitness."""
-    ntrees = count_trees_of_depth_LE(2, vars, fns)
+    their semantics vector and fitness. target can be a list of
+    target functions, in which case fit has one column per target."""
+    X = pagie_hogeweg_X()
+    target_vals = target_values(target, X)
     sem = []
     fit = []
-    X = pagie_hogeweg_X()
-    for t, d in trees_of_depth_LE(n, vars, fns, False):
-        sem.append(semantics(X, t))
-        fit.append(fitness(t, target)) # madly inefficient
-    sem = np.array(sem)
-    fit = np.array(fit)
+    for d, block in semantics_blocks(n, vars, fns, X):
+        sem.append(block)
+        fit.append(fitness_of_semantics(block, target_vals))
+    sem = np.vstack(sem)
+    fit = np.concatenate(fit)
     return fit, sem
 
-def semantic_distances(n, vars, fns):
+def fitness_and_semantics_chunks(n, vars, fns, target=pagie_hogeweg_fn,
+                                 chunksize=2**16, start=0):
+    """Generate (ids, sem, fit) for all trees of depth <= n, in
+    enumeration order, in chunks of chunksize trees (the last one may
+    be shorter). ids are the trees' indices in the enumeration. Only
+    one chunk is held in memory at a time. Enumeration begins at tree
+    number start."""
+    X = pagie_hogeweg_X()
+    target_vals = target_values(target, X)
+    buf = []
+    nbuf = 0
+    pos = start
+    for d, block in semantics_blocks(n, vars, fns, X, start):
+        while len(block):
+            take = min(chunksize - nbuf, len(block))
+            buf.append(block[:take])
+            nbuf += take
+            block = block[take:]
+            if nbuf == chunksize:
+                sem = np.vstack(buf)
+                yield np.arange(pos, pos + nbuf), sem, fitness_of_semantics(sem, target_vals)
+                pos += nbuf
+                buf = []
+                nbuf = 0
+    if nbuf:
+        sem = np.vstack(buf)
+        yield np.arange(pos, pos + nbuf), sem, fitness_of_semantics(sem, target_vals)
+
+def write_fitness_and_semantics(n, vars, fns, dirname,
+                                targets=(("", pagie_hogeweg_fn),),
+                                chunksize=2**16):
+    """Stream the semantics and fitness of all trees of depth <= n to
+    binary files in dirname: all_trees_semantics.npy and, for each
+    (suffix, target) in targets, all_trees_fitness<suffix>.npy. The
+    files are memory-mapped and written a chunk at a time, so this
+    works when the full arrays don't fit in memory.
+
+    After each chunk is flushed the number of trees done is written
+    to all_trees_semantics.checkpoint. If that file exists when we
+    start, the existing files are opened and the enumeration resumes
+    from there instead of starting from zero."""
+    ntrees = count_trees_of_depth_LE(n, vars, fns)
+    npoints = pagie_hogeweg_X().shape[1]
+    sem_filename = os.path.join(dirname, "all_trees_semantics.npy")
+    fit_filenames = [os.path.join(dirname, "all_trees_fitness%s.npy" % suffix)
+                     for suffix, target in targets]
+    checkpoint_filename = os.path.join(dirname, "all_trees_semantics.checkpoint")
+
+    done = 0
+    if os.path.exists(checkpoint_filename):
+        done = int(open(checkpoint_filename).read())
+    if done:
+        sem_out = np.lib.format.open_memmap(sem_filename, mode="r+")
+        fit_outs = [np.lib.format.open_memmap(f, mode="r+") for f in fit_filenames]
+        if sem_out.shape != (ntrees, npoints) or any(f.shape != (ntrees,) for f in fit_outs):
+            raise ValueError("Checkpoint doesn't match the files in " + dirname)
+        print("Resuming from tree %d of %d" % (done, ntrees))
+    else:
+        sem_out = np.lib.format.open_memmap(sem_filename, mode="w+",
+                                            dtype=float, shape=(ntrees, npoints))
+        fit_outs = [np.lib.format.open_memmap(f, mode="w+", dtype=float, shape=(ntrees,))
+                    for f in fit_filenames]
+
+    target = [t for suffix, t in targets]
+    for ids, sem, fit in fitness_and_semantics_chunks(n, vars, fns, target,
+                                                      chunksize, done):
+        sem_out[ids[0]:ids[-1]+1] = sem
+        for k, fit_out in enumerate(fit_outs):
+            fit_out[ids[0]:ids[-1]+1] = fit[:, k]
+        sem_out.flush()
+        for fit_out in fit_outs:
+            fit_out.flush()
+        # write-then-rename, so the checkpoint is never half-written
+        tmp = checkpoint_filename + ".tmp"
+        open(tmp, "w").write("%d\n" % (ids[-1] + 1))
+        os.rename(tmp, checkpoint_filename)
+    del sem_out, fit_outs
+
+def semantic_distances_of_semantics(sem, outfilename=None, blocksize=1024, nprocs=None):
+    """Pairwise semantic distances log(1 + RMS(s_i - s_j)) between the
+    rows of sem (log because semantic distances can be huge).
+
+    Squared distances come from the expansion |a|^2 + |b|^2 - 2ab, so
+    the bulk of the work is block-by-block matrix products done by
+    BLAS. Only blocks on or above the diagonal are calculated; each is
+    mirrored into the lower triangle. Blocks are farmed out to a pool
+    of threads (BLAS releases the GIL). Where the expansion loses
+    precision to cancellation (near-identical rows) the entries are
+    recalculated directly. If outfilename is given, the result is a
+    memory-mapped .npy of that name, else an in-memory array."""
+    sem = np.asarray(sem, dtype=float)
+    N, npoints = sem.shape
+    norms = np.einsum("ij,ij->i", sem, sem)
+    if outfilename is None:
+        out = np.empty((N, N))
+    else:
+        out = np.lib.format.open_memmap(outfilename, mode="w+", dtype=float, shape=(N, N))
+
+    def do_block(ij):
+        i, j = ij
+        I = slice(i, min(i + blocksize, N))
+        J = slice(j, min(j + blocksize, N))
+        with np.errstate(all="ignore"):
+            d2 = np.dot(sem[I], sem[J].T)
+            d2 *= -2.0
+            d2 += norms[I, np.newaxis]
+            d2 += norms[np.newaxis, J]
+            # cancellation: recalculate entries which are tiny compared
+            # to the norms they came from
+            scale = norms[I, np.newaxis] + norms[np.newaxis, J]
+            bad = np.nonzero(d2 <= 1e-8 * scale)
+            for a, b in zip(*bad):
+                diff = sem[i + a] - sem[j + b]
+                d2[a, b] = np.dot(diff, diff)
+            np.maximum(d2, 0.0, out=d2)
+            d2 /= npoints
+            np.sqrt(d2, out=d2)
+            np.log1p(d2, out=d2)
+        if i == j:
+            # make it exactly symmetric
+            lower = np.tril_indices(len(d2), -1)
+            d2[lower] = d2.T[lower]
+            np.fill_diagonal(d2, 0.0)
+        out[I, J] = d2
+        out[J, I] = d2.T
+
+    blocks = [(i, j) for i in range(0, N, blocksize) for j in range(i, N, blocksize)]
+    if nprocs is None:
+        nprocs = multiprocessing.cpu_count()
+    if nprocs == 1 or len(blocks) < 2:
+        map(do_block, blocks)
+    else:
+        pool = ThreadPool(nprocs)
+        try:
+            pool.map(do_block, blocks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    if outfilename is not None:
+        out.flush()
+    return out
+
+def semantic_distances(n, vars, fns, outfilename=None, nprocs=None):
     """For all tree of depth <= n with given alphabet, calculate the
     semantic distances between pairs of trees."""
-    semantics, fitness = enumerate_fitness_and_semantics(n, vars, fns)
-    ntrees = semantics.shape[0]
-    result = np.zeros((ntrees, ntrees))
-    for i, t in enumerate(semantics):
-        for j, s in enumerate(semantics):
-            d = np.sqrt(np.mean((t - s)**2.0))
-            d = np.log(1.0 + d) # log because semantic dists can be huge
-            result[i, j] = d
-    return result
+    fit, sem = enumerate_fitness_and_semantics(n, vars, fns)
+    return semantic_distances_of_semantics(sem, outfilename, nprocs=nprocs)
     
 if __name__ == "__main__":
 
@@ -173,7 +840,13 @@ if __name__ == "__main__":
             
     elif len(sys.argv) > 2 and sys.argv[2].startswith("enumerate_fitness_and_semantics"):
         dirname = sys.argv[3]
-        if sys.argv[2].endswith("alternate_target"):
+        if sys.argv[2].endswith("all_targets"):
+            # both targets from a single enumeration
+            fit, sem = enumerate_fitness_and_semantics(n, vars, fns, [pagie_hogeweg_fn, another_target_fn])
+            np.savetxt(dirname + "/all_trees_semantics.dat", sem)
+            np.savetxt(dirname + "/all_trees_fitness.dat", fit[:, 0])
+            np.savetxt(dirname + "/all_trees_fitness_alternate_target.dat", fit[:, 1])
+        elif sys.argv[2].endswith("alternate_target"):
             fit, sem = enumerate_fitness_and_semantics(n, vars, fns, another_target_fn)
             np.savetxt(dirname + "/all_trees_semantics_alternate_target.dat", sem)
             np.savetxt(dirname + "/all_trees_fitness_alternate_target.dat", fit)
@@ -182,10 +855,35 @@ if __name__ == "__main__":
             np.savetxt(dirname + "/all_trees_semantics.dat", sem)
             np.savetxt(dirname + "/all_trees_fitness.dat", fit)
             
+    elif len(sys.argv) > 2 and sys.argv[2] == "write_fitness_and_semantics":
+        # binary, chunked and resumable: suitable for depth 3
+        dirname = sys.argv[3]
+        write_fitness_and_semantics(n, vars, fns, dirname,
+                                    (("", pagie_hogeweg_fn),
+                                     ("_alternate_target", another_target_fn)))
+
+    elif len(sys.argv) > 2 and sys.argv[2] == "sample":
+        # eg generate_trees.py 6 sample 1000 ../../results/uniform_depth_6
+        # uses the variable names of the Java code, so that the
+        # output can be used in place of its all_trees.dat.
+        k = int(sys.argv[3])
+        dirname = sys.argv[4]
+        write_sample(k, n, ["x", "y"], fns, dirname)
+
+    elif len(sys.argv) > 2 and sys.argv[2] == "benchmark":
+        benchmark_evaluators(n, vars, fns)
+
     elif len(sys.argv) > 2 and sys.argv[2] == "semantic_distances":
         dirname = sys.argv[3]
         result = semantic_distances(n, vars, fns)
         np.savetxt(dirname + "/SEMD.dat", result)
+
+    elif len(sys.argv) > 2 and sys.argv[2] == "semantic_distances_binary":
+        # from the semantics written by write_fitness_and_semantics,
+        # to a memory-mapped SEMD.npy
+        dirname = sys.argv[3]
+        sem = np.load(os.path.join(dirname, "all_trees_semantics.npy"), mmap_mode="r")
+        semantic_distances_of_semantics(sem, os.path.join(dirname, "SEMD.npy"))
         
     else:
         print(count_trees_of_depth_LE(n, vars, fns))
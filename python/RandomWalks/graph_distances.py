@@ -11,6 +11,7 @@ from numpy import dot as d
 import random
 import sys
 from random_walks import set_self_transition_zero, read_transition_matrix
+import markov
 
 def get_Boley_undirected(tp):
     """Boley et al define an undirected graph which "corresponds to" a
@@ -343,8 +344,25 @@ D_FE =
     # A = np.array([[0.5, 0.5], [0.1, 0.9]])
 
 
-def get_commute_distance_using_Laplacian(S):
+def adjacency_chain(S, k=None):
+    """The random walk on the undirected graph S as a
+    markov.ReversibleChain (top k eigenpairs only, if k is given).
+    Pass it to get_commute_distance_using_Laplacian, and use its own
+    methods for resistances, MFPT etc., to share one
+    eigendecomposition; make a new one if S changes."""
+    return markov.ReversibleChain.from_adjacency(S, k)
+
+def get_commute_distance_using_Laplacian(S, k=None, chain=None):
+    """Commute time distance of the random walk on S. A random walk
+    on an undirected graph always has detailed balance, so if chain
+    (see adjacency_chain) or k is given, the spectral engine is used.
+    Otherwise a single inverse of the Laplacian is cheaper than an
+    eigendecomposition."""
     assert np.allclose(S, S.T)
+    if chain is None and k is not None:
+        chain = adjacency_chain(S, k)
+    if chain is not None:
+        return chain.commute_time()
 
     n = S.shape[0]
     # compute global graph laplacian: 
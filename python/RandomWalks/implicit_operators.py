@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+
+"""This module provides transition matrices which are never formed
+explicitly. They are scipy LinearOperators, so they can be passed to
+iterative solvers. They also provide the things the rest of the code
+needs from a transition matrix: rows (tp[i]), the neighbours of a
+state with their probabilities, sampling a neighbour, the steady
+state and MFPT. random_walks dispatches to these methods where it
+would otherwise work on a dense matrix.
+
+NeighbourhoodOperator is the general case: a subclass says what the
+neighbours of a state are, and everything else follows, with
+iterative solvers for the steady state and MFPT. Neighbours are
+generated on the fly, and the sparse table of them is only built (and
+then kept) when a whole mat-vec is needed. BitflipOperator and TSPOperator
+are the one-bitflip GA and the 2-opt/3-opt TSP spaces of
+random_walks.generate_ga_tm and random_walks.sample_transitions.
+
+KroneckerBitflipOperator is the GA per-gene mutation matrix from
+random_walks.generate_ga_tm(length, pmut). That matrix is the
+length-fold Kronecker product of the 2x2 matrix [[1-p, p], [p, 1-p]],
+so it's diagonalised by the Walsh-Hadamard transform, and almost
+everything about it can be calculated in O(n log n) for n =
+2**length states. The one-bitflip matrix is diagonalised the same
+way."""
+
+import numpy as np
+import scipy.sparse.linalg
+import scipy.sparse
+import random
+import sys
+from random_walks import (onemax_fitvals, nCk, two_opt, two_opt_moves,
+                          three_opt, three_opt_moves, tsp_tour_rank,
+                          tsp_tour_unrank)
+
+def fwht(a):
+    """Fast (unnormalised) Walsh-Hadamard transform of a vector whose
+    length is a power of 2. Applying it twice multiplies by n."""
+    a = np.array(a, dtype=float)
+    n = len(a)
+    h = 1
+    while h < n:
+        a = a.reshape((-1, 2, h))
+        x = a[:, 0, :].copy()
+        a[:, 0, :] += a[:, 1, :]
+        a[:, 1, :] = x - a[:, 1, :]
+        a = a.reshape(n)
+        h *= 2
+    return a
+
+class NeighbourhoodOperator(scipy.sparse.linalg.LinearOperator):
+    """A transition matrix given by the neighbours of each state.
+    Subclasses define neighbours(i), returning an array of states and
+    an array of their probabilities."""
+
+    # how many states' neighbours to remember, eg during walks
+    cache_size = 100000
+
+    def __init__(self, n):
+        self._neighbours = {}
+        self._sparse = None
+        scipy.sparse.linalg.LinearOperator.__init__(self, float, (n, n))
+
+    def neighbours(self, i):
+        raise NotImplementedError
+
+    def cached_neighbours(self, i):
+        try:
+            return self._neighbours[i]
+        except KeyError:
+            result = self.neighbours(i)
+            if len(self._neighbours) < self.cache_size:
+                self._neighbours[i] = result
+            return result
+
+    def __getitem__(self, i):
+        """Row i, as a dense vector."""
+        row = np.zeros(self.shape[0])
+        states, probs = self.cached_neighbours(i)
+        np.add.at(row, states, probs)
+        return row
+
+    def sample_neighbour(self, i):
+        states, probs = self.cached_neighbours(i)
+        r = random.random() * np.sum(probs)
+        return states[min(np.searchsorted(np.cumsum(probs), r, side="right"),
+                          len(states) - 1)]
+
+    def to_sparse(self):
+        """The whole matrix as a CSR matrix, built once from the
+        neighbours of every state."""
+        if self._sparse is None:
+            rows, cols, vals = [], [], []
+            for i in range(self.shape[0]):
+                states, probs = self.neighbours(i)
+                rows.append(np.repeat(i, len(states)))
+                cols.append(states)
+                vals.append(probs)
+            self._sparse = scipy.sparse.csr_matrix(
+                (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                shape=self.shape)
+        return self._sparse
+
+    def _matvec(self, v):
+        return self.to_sparse().dot(np.ravel(v))
+
+    def _rmatvec(self, v):
+        return self.to_sparse().T.dot(np.ravel(v))
+
+    def todense(self):
+        return self.to_sparse().toarray()
+
+    def steady_state(self, tol=1e-12):
+        """The left eigenvector with eigenvalue 1, found iteratively.
+        The walk is made lazy, (I + P) / 2, which has the same steady
+        state but no other eigenvalues on the unit circle."""
+        lazy = scipy.sparse.linalg.LinearOperator(
+            self.shape, rmatvec=None, dtype=float,
+            matvec=lambda v: 0.5 * (np.ravel(v) + self.rmatvec(v)))
+        vals, vecs = scipy.sparse.linalg.eigs(lazy, k=1, which="LR", tol=tol)
+        ss = np.real(vecs[:, 0])
+        return ss / ss.sum()
+
+    def mfpt_to(self, j, tol=1e-10):
+        """Mean first passage times from every state to state j. They
+        solve m_i = 1 + sum_k P_ik m_k for i != j, with m_j = 0, which
+        we solve iteratively using only mat-vecs."""
+        n = self.shape[0]
+        mask = np.ones(n)
+        mask[j] = 0.0
+        def A(x):
+            x = np.ravel(x)
+            return x - mask * self.matvec(mask * x)
+        A = scipy.sparse.linalg.LinearOperator(self.shape, matvec=A, dtype=float)
+        m, info = scipy.sparse.linalg.bicgstab(A, mask, tol=tol, atol=tol)
+        if info != 0:
+            raise ValueError("MFPT solve didn't converge (info=%d)" % info)
+        return m
+
+    def mfpt(self):
+        """The full MFPT matrix, as random_walks.get_mfpt would give,
+        one target at a time."""
+        return np.array([self.mfpt_to(j) for j in range(self.shape[0])]).T
+
+class XorInvariantOperator(NeighbourhoodOperator):
+    """A walk on bitstrings of the given length where the probability
+    of moving from i to j depends only on i xor j. Such a matrix is
+    doubly stochastic, and diagonalised by the Walsh functions, so
+    subclasses need only give its eigenvalues."""
+
+    def __init__(self, length):
+        self.length = length
+        self._popcounts = None
+        NeighbourhoodOperator.__init__(self, 2**length)
+
+    def _popcount_xor(self, i):
+        """Hamming distances from state i to every state."""
+        if self._popcounts is None:
+            self._popcounts = onemax_fitvals(self.length)
+        return self._popcounts[np.arange(self.shape[0]) ^ i]
+
+    def steady_state(self):
+        """P is doubly stochastic, so the steady state is uniform."""
+        n = self.shape[0]
+        return np.ones(n) / n
+
+    def _fundamental_row(self):
+        """Row 0 of the fundamental matrix Z = inv(I - P + 1 pi'). Z
+        commutes with xor, so Z[i, j] = z[i ^ j]. Its eigenvalues are 1
+        for the constant Walsh function and 1 / (1 - lambda_k)
+        otherwise."""
+        n = self.shape[0]
+        lam = self.eigenvalues()
+        c = np.ones(n)
+        c[1:] = 1.0 / (1.0 - lam[1:])
+        return fwht(c) / n
+
+    def mfpt_row(self, i, z=None):
+        """Mean first passage times from state i to every state: m_ij
+        = (Z_jj - Z_ij) / pi_j, with the diagonal zero as in
+        random_walks.get_mfpt."""
+        if z is None:
+            z = self._fundamental_row()
+        n = self.shape[0]
+        return n * (z[0] - z[np.arange(n) ^ i])
+
+    def mfpt_to(self, j):
+        # m_ij depends only on i ^ j, so the column is the row
+        return self.mfpt_row(j)
+
+    def mfpt(self):
+        z = self._fundamental_row()
+        return np.array([self.mfpt_row(i, z) for i in range(self.shape[0])])
+
+class BitflipOperator(XorInvariantOperator):
+    """Exactly one uniformly chosen bit is flipped, as
+    generate_ga_tm(length, None)."""
+
+    def neighbours(self, i):
+        states = i ^ (1 << np.arange(self.length))
+        return states, np.ones(self.length) / self.length
+
+    def _matvec(self, v):
+        v = np.ravel(v)
+        idx = np.arange(self.shape[0])
+        result = np.zeros(self.shape[0])
+        for b in range(self.length):
+            result += v[idx ^ (1 << b)]
+        return result / self.length
+
+    def _rmatvec(self, v):
+        return self._matvec(v)
+
+    def __getitem__(self, i):
+        row = np.zeros(self.shape[0])
+        row[i ^ (1 << np.arange(self.length))] = 1.0 / self.length
+        return row
+
+    def todense(self):
+        return np.array([self[i] for i in range(self.shape[0])])
+
+    def sample_neighbour(self, i):
+        return i ^ (1 << random.randrange(self.length))
+
+    def eigenvalues(self):
+        """The Walsh function of k has eigenvalue 1 - 2 popcount(k) /
+        length."""
+        return 1.0 - 2.0 * onemax_fitvals(self.length) / float(self.length)
+
+    def uniformify(self, q):
+        # all nonzero entries are equal, so it's unchanged
+        return self
+
+    def mu_sigma(self):
+        L = self.length
+        n = float(self.shape[0])
+        sigma = np.sqrt((L * (1.0 / L - 1.0 / n)**2 + (n - L) * (1.0 / n)**2) / n)
+        return sigma, 0.0
+
+class KroneckerBitflipOperator(XorInvariantOperator):
+    """The transition matrix of per-gene bitflip mutation on
+    bitstrings of the given length, with mutation probability pmut,
+    indexed like generate_ga_tm (state i is the bitstring of i, most
+    significant bit first). P[i, j] = p^h (1-p)^(length-h), where h is
+    the Hamming distance between i and j."""
+
+    def __init__(self, length, pmut):
+        if not 0.0 < pmut < 1.0:
+            raise ValueError("pmut must be strictly between 0 and 1")
+        self.pmut = float(pmut)
+        XorInvariantOperator.__init__(self, length)
+
+    def _matvec(self, v):
+        # multiply by the 2x2 kernel along each bit's axis in turn
+        p = self.pmut
+        v = np.asarray(v, dtype=float).reshape((2,) * self.length)
+        for axis in range(self.length):
+            v = (1.0 - p) * v + p * np.flip(v, axis)
+        return v.reshape((self.shape[0], 1))
+
+    def _rmatvec(self, v):
+        # P is symmetric
+        return self._matvec(v)
+
+    def __getitem__(self, i):
+        """Row i, as a dense vector."""
+        p = self.pmut
+        h = self._popcount_xor(i)
+        return (1.0 - p)**self.length * (p / (1.0 - p))**h
+
+    def neighbours(self, i):
+        """Every state is a neighbour."""
+        return np.arange(self.shape[0]), self[i]
+
+    def todense(self):
+        return np.array([self[i] for i in range(self.shape[0])])
+
+    def sample_neighbour(self, i):
+        """The next state from i: flip each bit with probability p."""
+        mask = 0
+        for b in range(self.length):
+            if random.random() < self.pmut:
+                mask |= 1 << b
+        return i ^ mask
+
+    def eigenvalues(self):
+        """The exact spectrum: the eigenvector given by the Walsh
+        function of k has eigenvalue (1-2p)^popcount(k)."""
+        return (1.0 - 2.0 * self.pmut)**onemax_fitvals(self.length)
+
+    def uniformify(self, q):
+        """As random_walks.uniformify: raising every entry to the power
+        q and renormalising the rows gives another operator of the same
+        kind, with the kernel [(1-p)^q, p^q] normalised."""
+        p = self.pmut
+        return KroneckerBitflipOperator(self.length, p**q / ((1.0 - p)**q + p**q))
+
+    def mu_sigma(self):
+        """As random_walks.mu_sigma. Every row is a permutation of row
+        0, so the row stddevs are all equal: it's enough to count how
+        many entries are at each Hamming distance."""
+        L, p = self.length, self.pmut
+        n = float(self.shape[0])
+        h = np.arange(L + 1)
+        vals = p**h * (1.0 - p)**(L - h)
+        counts = np.array([nCk(L, k) for k in h], dtype=float)
+        sigma = np.sqrt(np.sum(counts * (vals - 1.0 / n)**2) / n)
+        return sigma, 0.0
+
+class TSPOperator(NeighbourhoodOperator):
+    """The 2-opt or 3-opt walk on canonical tours of ncities cities,
+    as random_walks.sample_transitions, but with exact probabilities:
+    each state's neighbours come from applying every move two_opt or
+    three_opt could choose, with its probability. States are
+    numbered as in tsp_tours, via tsp_tour_rank and
+    tsp_tour_unrank."""
+
+    def __init__(self, ncities, opt=2, broad=False):
+        self.ncities = ncities
+        if opt == 3:
+            self.moves = three_opt_moves(ncities, broad)
+            self.move = lambda p, m: three_opt(p, broad, m)
+        else:
+            self.moves = two_opt_moves(ncities)
+            self.move = two_opt
+        # (ncities - 1)! / 2 canonical tours
+        n = 1
+        for k in range(3, ncities):
+            n *= k
+        NeighbourhoodOperator.__init__(self, n)
+
+    def neighbours(self, i):
+        tour = list(tsp_tour_unrank(i, self.ncities))
+        probs = {}
+        for m, prob in self.moves:
+            j = tsp_tour_rank(self.move(tour, m))
+            probs[j] = probs.get(j, 0.0) + prob
+        states = np.array(sorted(probs))
+        return states, np.array([probs[j] for j in states])
+
+    def sample_neighbour(self, i):
+        # one random move, as in the sampled version
+        tour = list(tsp_tour_unrank(i, self.ncities))
+        m, prob = random.choice(self.moves)
+        return tsp_tour_rank(self.move(tour, m))
+
+def test_kronecker_bitflip(length=6, pmut=0.1):
+    """Check the operator against the dense matrix and functions in
+    random_walks."""
+    import random_walks
+    op = KroneckerBitflipOperator(length, pmut)
+    tp, hm = random_walks.generate_ga_tm(length, pmut)
+    v = np.random.random(len(tp))
+    print("todense: %s" % np.allclose(op.todense(), tp))
+    print("matvec: %s" % np.allclose(op.matvec(v), tp.dot(v)))
+    print("eigenvalues: %s" % np.allclose(np.sort(op.eigenvalues()),
+                                          np.sort(np.linalg.eigvalsh(tp))))
+    print("MFPT: %s" % np.allclose(op.mfpt(), random_walks.get_mfpt(tp)))
+    for q in [0.5, 2.0]:
+        print("uniformify %.1f: %s" % (q, np.allclose(op.uniformify(q).todense(),
+                                                       random_walks.uniformify(tp, q))))
+    print("mu_sigma: %s" % np.allclose(op.mu_sigma(), random_walks.mu_sigma(tp)))
+
+def test_neighbourhood_operators(length=6, ncities=6):
+    """Check the matrix-free operators against the dense matrices
+    and functions in random_walks."""
+    import random_walks
+    op = BitflipOperator(length)
+    tp, hm = random_walks.generate_ga_tm(length)
+    v = np.random.random(len(tp))
+    print("bitflip todense: %s" % np.allclose(op.todense(), tp))
+    print("bitflip matvec: %s" % np.allclose(op.matvec(v), tp.dot(v)))
+    print("bitflip MFPT: %s" % np.allclose(op.mfpt(), random_walks.get_mfpt(tp)))
+    print("bitflip mu_sigma: %s" % np.allclose(op.mu_sigma(), random_walks.mu_sigma(tp)))
+    for opt in [2, 3]:
+        op = TSPOperator(ncities, opt)
+        tp = op.todense()
+        sampled = random_walks.sample_transitions(ncities, opt, 2000)
+        print("%d-opt rows sum to 1: %s" % (opt, np.allclose(tp.sum(1), 1.0)))
+        print("%d-opt max difference from sampled: %.3f" % (opt, np.abs(tp - sampled).max()))
+        print("%d-opt steady state: %s" % (opt, np.allclose(op.steady_state(),
+                                                            random_walks.get_steady_state(tp))))
+        mfpt = random_walks.get_mfpt(tp)
+        print("%d-opt MFPT to 0: %s" % (opt, np.allclose(op.mfpt_to(0), mfpt[:, 0])))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "test":
+        test_kronecker_bitflip()
+        test_neighbourhood_operators()
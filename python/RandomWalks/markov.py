@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+
+"""This module provides Markov chain calculations which keep state
+between queries, rather than starting from the transition matrix
+each time as ergodic.py and random_walks.get_mfpt do.
+
+IncrementalMFPT keeps the fundamental matrix of an ergodic chain, so
+that after a few rows of the transition matrix change (eg a state is
+reweighted by a hill-climb, or a sub-graph renormalised) the steady
+state and MFPT are updated by a low-rank correction in O(kn^2) instead
+of being recomputed from scratch in O(n^3).
+
+ReversibleChain decomposes a chain which has detailed balance once,
+and then gives the MFPT, commute times, Kemeny's constant and the
+n-step transition probabilities from the same eigenpairs.
+
+taboo_survival and first_passage_distribution give the whole
+distribution of first-passage times, not just the mean, by
+propagating the probability of not yet having hit a target."""
+
+import numpy as np
+import scipy.sparse, scipy.sparse.linalg
+import sys
+
+class IncrementalMFPT(object):
+    """MFPT of an ergodic chain with transition matrix P, under row
+    updates.
+
+    We keep G = inv(I - P + 1w') with w uniform. Then the steady state
+    is pi' = w'G, and the MFPT is m_ij = (G_jj - G_ij) / pi_j (zero on
+    the diagonal, as random_walks.get_mfpt). Changing k rows of P
+    changes that matrix by a rank-k term, so G is updated by the
+    Sherman-Morrison-Woodbury formula. Rounding errors accumulate, so
+    once the total rank of the updates since G was last calculated
+    from scratch passes refactor_after, it is recalculated."""
+
+    def __init__(self, P, refactor_after=None):
+        self.P = np.array(P, dtype=float)
+        n = len(self.P)
+        self.w = np.ones(n) / n
+        if refactor_after is None:
+            refactor_after = max(1, n // 10)
+        self.refactor_after = refactor_after
+        self.refactor()
+
+    def refactor(self):
+        """Calculate G from scratch from the current P."""
+        n = len(self.P)
+        self.G = np.linalg.inv(np.eye(n) - self.P + self.w[np.newaxis, :])
+        self.pi = self.w.dot(self.G)
+        self.updates = 0
+
+    def update_rows(self, rows, new_rows):
+        """Replace the given rows of P (a list of state indices) by
+        new_rows (one row each, summing to 1)."""
+        rows = list(rows)
+        new_rows = np.atleast_2d(np.asarray(new_rows, dtype=float))
+        D = new_rows - self.P[rows]
+        self.P[rows] = new_rows
+        self.updates += len(rows)
+        if self.updates > self.refactor_after:
+            self.refactor()
+            return
+        # I - P + 1w' loses U D, where U has columns e_r for r in rows:
+        # inv(A - U D) = G + G U inv(I - D G U) D G
+        GU = self.G[:, rows]
+        DG = D.dot(self.G)
+        K = np.eye(len(rows)) - D.dot(GU)
+        self.G += GU.dot(np.linalg.solve(K, DG))
+        self.pi = self.w.dot(self.G)
+
+    def update_row(self, row, new_row):
+        self.update_rows([row], [new_row])
+
+    def steady_state(self):
+        return self.pi.copy()
+
+    def mfpt_to(self, j):
+        """MFPT from every state to state j."""
+        m = (self.G[j, j] - self.G[:, j]) / self.pi[j]
+        m[j] = 0.0
+        return m
+
+    def mfpt(self):
+        """The full MFPT matrix."""
+        m = (np.diag(self.G)[np.newaxis, :] - self.G) / self.pi[np.newaxis, :]
+        np.fill_diagonal(m, 0.0)
+        return m
+
+def steady_state(P):
+    """The steady state of an ergodic chain, by solving
+    pi'(I - P + 1w') = w' with w uniform (see IncrementalMFPT). A
+    scipy.sparse P is handled by eigs instead."""
+    n = P.shape[0]
+    if scipy.sparse.issparse(P):
+        vals, vecs = scipy.sparse.linalg.eigs(P.T, 1, which="LR")
+        pi = np.real(vecs[:, 0])
+    else:
+        w = np.ones(n) / n
+        pi = np.linalg.solve((np.eye(n) - P + w[np.newaxis, :]).T, w)
+    return pi / pi.sum()
+
+class ReversibleChain(object):
+    """Spectral calculations for a chain P with detailed balance,
+    pi_i P_ij = pi_j P_ji.
+
+    Then S = D^1/2 P D^-1/2 (D = diag(pi)) is symmetric, so it has
+    real eigenvalues lam_k and orthonormal eigenvectors u_k, found
+    once by eigh. With V = D^-1/2 U and W = D^1/2 U, P^t = V lam^t W',
+    and everything else follows: eg the MFPT is m_ij = sum_k c_k
+    (V_jk^2 - V_ik V_jk), with c_k = 1/(1 - lam_k), summing over all
+    but the stationary eigenvalue lam = 1.
+
+    If k is given, only the top k eigenpairs are found (by eigsh, so
+    P may be scipy.sparse), and the results are approximations
+    dominated by the slowest-mixing modes. Raises ValueError if P
+    doesn't have detailed balance."""
+
+    def __init__(self, P, pi=None, k=None, check=True):
+        sparse = scipy.sparse.issparse(P)
+        if not sparse:
+            P = np.asarray(P, dtype=float)
+        if pi is None:
+            pi = steady_state(P)
+        pi = np.asarray(pi, dtype=float)
+        if not pi.min() > 0:
+            raise ValueError("chain isn't ergodic")
+        n = len(pi)
+        if sparse:
+            F = scipy.sparse.diags(pi).dot(P)
+            if check and abs(F - F.T).max() > 1e-8 * abs(F).max():
+                raise ValueError("chain doesn't have detailed balance")
+            s = np.sqrt(pi)
+            S = scipy.sparse.diags(s).dot(P).dot(scipy.sparse.diags(1.0 / s))
+        else:
+            F = pi[:, np.newaxis] * P
+            # relative: for large n the flows are all tiny
+            if check and np.abs(F - F.T).max() > 1e-8 * np.abs(F).max():
+                raise ValueError("chain doesn't have detailed balance")
+            s = np.sqrt(pi)
+            S = P * s[:, np.newaxis] / s[np.newaxis, :]
+        S = (S + S.T) / 2.0
+        if k is None or k >= n:
+            if sparse:
+                S = S.toarray()
+            lam, U = np.linalg.eigh(S)
+        else:
+            lam, U = scipy.sparse.linalg.eigsh(S, k, which="LA")
+        # descending, so the stationary eigenvalue comes first
+        idx = np.argsort(-lam)
+        self.lam = lam[idx]
+        self.U = U[:, idx]
+        self.pi = pi
+        self.V = self.U / s[:, np.newaxis]
+        self.W = self.U * s[:, np.newaxis]
+        self.c = np.zeros(len(self.lam))
+        self.c[1:] = 1.0 / (1.0 - self.lam[1:])
+        # the edge weights pi_i P_ij sum to 1. see from_adjacency.
+        self.vol = 1.0
+
+    @classmethod
+    def from_adjacency(cls, A, k=None):
+        """The random walk on an undirected weighted graph, given its
+        symmetric adjacency matrix A: P_ij = A_ij / d_i and pi_i = d_i
+        / vol, where d is the degree and vol the total of A."""
+        A = np.asarray(A, dtype=float)
+        d = A.sum(1)
+        vol = d.sum()
+        chain = cls(A / d[:, np.newaxis], d / vol, k, check=False)
+        chain.vol = vol
+        return chain
+
+    def steady_state(self):
+        return self.pi.copy()
+
+    def matrix_power(self, t):
+        """P^t."""
+        return (self.V * self.lam ** t).dot(self.W.T)
+
+    def fundamental_matrix(self):
+        """Z = inv(I - P + 1pi')."""
+        Z = (self.V * self.c).dot(self.W.T)
+        Z += self.pi[np.newaxis, :]
+        return Z
+
+    def mfpt(self):
+        """The MFPT matrix, zero on the diagonal as
+        random_walks.get_mfpt."""
+        Vc = self.V * self.c
+        m = (Vc * self.V).sum(1)[np.newaxis, :] - Vc.dot(self.V.T)
+        np.fill_diagonal(m, 0.0)
+        return m
+
+    def mfpt_to(self, j):
+        """MFPT from every state to state j."""
+        Vc = self.V[j] * self.c
+        m = Vc.dot(self.V[j]) - self.V.dot(Vc)
+        m[j] = 0.0
+        return m
+
+    def commute_time(self):
+        """m_ij + m_ji = sum_k c_k (V_ik - V_jk)^2."""
+        Vc = self.V * self.c
+        a = (Vc * self.V).sum(1)
+        ct = a[:, np.newaxis] + a[np.newaxis, :] - 2 * Vc.dot(self.V.T)
+        np.fill_diagonal(ct, 0.0)
+        return np.maximum(ct, 0.0)
+
+    def resistance(self):
+        """Effective resistance between states, where the conductance
+        of each edge is its weight (see from_adjacency): the commute
+        time divided by the volume."""
+        return self.commute_time() / self.vol
+
+    def kemeny_constant(self):
+        """sum_j pi_j m_ij, which is the same for every i."""
+        return self.c.sum()
+
+    def mstp(self, n):
+        """The probability of reaching j, starting from i, in n steps
+        or fewer (1 on the diagonal), as
+        random_walks.MSTP_max_n_steps. The first-passage probabilities
+        f_ij(s) satisfy P^t_ij = sum_{s=1..t} f_ij(s) P^(t-s)_jj, a
+        triangular Toeplitz system for each j, so sum_s f_ij(s) =
+        sum_t r_j(t) P^t_ij where r_j solves the transposed system
+        against a vector of ones. That sum is taken through the
+        eigenpairs, without forming any P^t."""
+        L = self.V.shape[0]
+        lam_t = self.lam[np.newaxis, :] ** np.arange(n + 1)[:, np.newaxis]
+        # pjj[t, j] = P^t_jj
+        pjj = lam_t.dot((self.V * self.W).T)
+        r = np.empty((n + 1, L))
+        for t in range(n, 0, -1):
+            r[t] = 1.0 - (pjj[1:n + 1 - t] * r[t + 1:]).sum(0)
+        g = lam_t[1:].T.dot(r[1:])
+        mstp = self.V.dot(self.W.T * g)
+        np.fill_diagonal(mstp, 1.0)
+        return np.clip(mstp, 0.0, 1.0)
+
+def _target_sets(targets):
+    """A list of target sets, each a list of states. A single int is
+    one singleton set, and an int in a list is its own singleton."""
+    if isinstance(targets, (int, np.integer)):
+        return [[targets]]
+    return [[t] if isinstance(t, (int, np.integer)) else list(t)
+            for t in targets]
+
+def taboo_survival(P, targets, horizon=None, tol=0.0, sources=None):
+    """Generate (t, H) for t = 0, 1, ..., where H[i, k] is the
+    probability that a walk on P started in state i hasn't entered
+    target set k by step t (not counting step 0, so for i in the set
+    this is about the return time). H_t = P (H_(t-1) masked to zero
+    on the targets), so all sources come at once, and all target sets
+    share one mat-mat product per step, which is a sparse one if P is
+    scipy.sparse. Stops after the horizon, or once H is at most tol
+    in the rows of the given sources (all states, by default). H is
+    reused between steps: copy it to keep it.
+
+    Without a horizon, raises ValueError if a source's survival is
+    above tol but has stopped decreasing, ie some of its probability
+    can never reach the target: if any of it could, some would within
+    n steps, n being the number of states."""
+    sets = _target_sets(targets)
+    if scipy.sparse.issparse(P):
+        P = P.tocsr()
+    else:
+        P = np.asarray(P, dtype=float)
+    n = P.shape[0]
+    rows = slice(None) if sources is None else list(sources)
+    mask = np.ones((n, len(sets)))
+    for k, s in enumerate(sets):
+        mask[s, k] = 0.0
+    H = np.ones((n, len(sets)))
+    t = 0
+    yield t, H
+    before = H[rows].copy()
+    while horizon is None or t < horizon:
+        H = P.dot(H * mask)
+        t += 1
+        yield t, H
+        if H[rows].max() <= tol:
+            break
+        if horizon is None and t % n == 0:
+            now = H[rows]
+            if np.any((now > tol) & (before - now <= 1e-12 * before)):
+                raise ValueError("survival stopped decreasing after %d steps: "
+                                 "a target can't be reached from a source, "
+                                 "so give a horizon" % t)
+            before = now.copy()
+
+def first_passage_distribution(P, targets, sources=None, horizon=None, tol=1e-8):
+    """The distribution of first-passage times to each target set
+    (see taboo_survival), from each source (all states, by default).
+    Returns f with f[t, i, k] = P(T = t), for t up to the horizon, or
+    until at most tol probability is left in every tail. f[0] is
+    zero. The MSTP within n steps is then f[:n+1].sum(0). Without a
+    horizon, raises ValueError if some target can't be reached."""
+    rows = slice(None) if sources is None else list(sources)
+    nsources = P.shape[0] if sources is None else len(rows)
+    shape = (nsources, len(_target_sets(targets)))
+    # survival at each step, in an array which doubles as needed
+    S = np.empty(((horizon or 64) + 1,) + shape)
+    for t, H in taboo_survival(P, targets, horizon, tol, sources):
+        if t == len(S):
+            S = np.concatenate((S, np.empty_like(S)))
+        S[t] = H[rows]
+    # P(T = t) = S[t-1] - S[t], in place, from the end
+    f = S[:t + 1]
+    for t in range(len(f) - 1, 0, -1):
+        np.subtract(f[t - 1], f[t], out=f[t])
+    f[0] = 0.0
+    return f
+
+def first_passage_quantiles(f, q=(0.05, 0.25, 0.5, 0.75, 0.95)):
+    """Quantiles of first-passage times, given f from
+    first_passage_distribution: the first t at which the cumulative
+    probability reaches each q. Result has the shape of f[0] with the
+    quantiles as a new first axis, and is inf where the horizon came
+    first."""
+    cdf = np.cumsum(f, axis=0)
+    result = np.empty((len(q),) + f.shape[1:])
+    for k, qk in enumerate(q):
+        reached = cdf >= qk - 1e-12
+        t = np.argmax(reached, axis=0).astype(float)
+        t[~reached.any(axis=0)] = np.inf
+        result[k] = t
+    return result
+
+def test_incremental_mfpt(n=60, nupdates=20):
+    """Check IncrementalMFPT against random_walks.get_mfpt after a
+    series of random row updates."""
+    import random_walks
+    P = random_walks.make_random_matrix(n)
+    inc = IncrementalMFPT(P, refactor_after=7)
+    for i in range(nupdates):
+        k = np.random.randint(1, 4)
+        rows = np.random.choice(n, k, replace=False)
+        new_rows = random_walks.normalise_by_row(np.random.random((k, n)))
+        inc.update_rows(rows, new_rows)
+        P[rows] = new_rows
+    print("steady state: %s" % np.allclose(inc.steady_state(), random_walks.get_steady_state(P)))
+    print("MFPT: %s" % np.allclose(inc.mfpt(), random_walks.get_mfpt(P)))
+
+def test_reversible_chain(length=6, pmut=0.2):
+    """Check ReversibleChain against the dense calculations in
+    random_walks, on a GA bitflip space."""
+    import random_walks
+    tp, _ = random_walks.generate_ga_tm(length, pmut)
+    chain = ReversibleChain(tp)
+    mfpt = np.array(random_walks.ergodic.fmpt(np.matrix(tp)))
+    np.fill_diagonal(mfpt, 0.0)
+    print("MFPT: %s" % np.allclose(chain.mfpt(), mfpt))
+    print("CT: %s" % np.allclose(chain.commute_time(), mfpt + mfpt.T))
+    print("Kemeny: %s" % np.allclose(mfpt.dot(chain.pi), chain.kemeny_constant()))
+    print("P^5: %s" % np.allclose(chain.matrix_power(5), np.linalg.matrix_power(tp, 5)))
+    n = len(tp)
+    mstp = np.eye(n)
+    for j in range(n):
+        x = tp.copy()
+        random_walks.make_absorbing(x, j)
+        mstp[:, j] = np.linalg.matrix_power(x, 10)[:, j]
+    print("MSTP: %s" % np.allclose(chain.mstp(10), mstp))
+    approx = ReversibleChain(tp, k=n // 2)
+    err = np.abs(approx.mfpt() - mfpt).max() / mfpt.max()
+    print("top-%d MFPT relative error: %f" % (n // 2, err))
+    print("shared chain: %s" % np.allclose(random_walks.get_mfpt(tp, chain), mfpt))
+    # nothing is cached by identity, so an edit in place is seen
+    tp[:] = random_walks.uniformify(tp, 2.0)
+    mfpt = np.array(random_walks.ergodic.fmpt(np.matrix(tp)))
+    np.fill_diagonal(mfpt, 0.0)
+    print("MFPT after edit: %s" % np.allclose(random_walks.get_mfpt(tp), mfpt))
+
+def test_first_passage_distribution(n=30, tol=1e-12):
+    """Check first-passage distributions against the MFPT and its
+    variance (ergodic.first_passage_moments), a sparse copy, and
+    sampling."""
+    import random_walks, ergodic
+    P = random_walks.make_random_matrix(n)
+    P[P < 0.03] = 0.0
+    P = random_walks.normalise_by_row(P)
+    m, m2 = ergodic.first_passage_moments(P)
+    f = first_passage_distribution(P, range(n), tol=tol)
+    t = np.arange(len(f))[:, np.newaxis, np.newaxis]
+    print("mean: %s" % np.allclose((t * f).sum(0), m, rtol=1e-4))
+    print("second moment: %s" % np.allclose((t * t * f).sum(0), m2, rtol=1e-4))
+    fs = first_passage_distribution(scipy.sparse.csr_matrix(P), range(n), tol=tol)
+    print("sparse: %s" % np.allclose(f, fs))
+    median = first_passage_quantiles(f, [0.5])[0, 0, 1]
+    samples = []
+    for rep in range(2000):
+        i, k = 0, 0
+        while True:
+            i = random_walks.roulette_wheel(P[i])
+            k += 1
+            if i == 1:
+                break
+        samples.append(k)
+    print("median 0 -> 1: exact %d, sampled %d" % (median, np.median(samples)))
+    # 1 is absorbing, so from 2 the target 0 is reached with probability 1/2
+    P = np.array([[.5, .5, 0], [0, 1, 0], [.3, .3, .4]])
+    try:
+        first_passage_distribution(P, [0], sources=[2])
+        print("unreachable target: no error")
+    except ValueError:
+        print("unreachable target: ValueError")
+    f = first_passage_distribution(P, [0], sources=[2], horizon=100)
+    print("unreachable target, horizon 100: %s" % np.allclose(f.sum(0), 0.5))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "test":
+        test_incremental_mfpt()
+        test_reversible_chain()
+        test_first_passage_distribution()
@@ -1,19 +1,20 @@
 #!/usr/bin/env python
 
-import pandas as pd
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
-from sklearn.manifold import MDS
 import numpy as np
 from matplotlib.ticker import FuncFormatter, MaxNLocator, IndexLocator
 import sys
 import os
+import time
+import multiprocessing
 from math import *
 import random
 import scipy.stats
 import scipy.stats.mstats
-from random_walks import set_self_transition_zero, map_infinity_to_large, tsp_tours
+from random_walks import set_self_transition_zero, map_infinity_to_large, tsp_tours, tsp_fitvals, load_array, tree_index
+import embedding
 
 # MAXTICKS is 1000 in IndexLocator
 class MyLocator(mpl.ticker.IndexLocator):
@@ -61,12 +62,16 @@ def syntactic_distance_names(dirname):
     else:
         raise ValueError("Unexpected dirname " + dirname)
 
-def make_grid_plots(dirname, plot_names=None):
+def make_grid_plots(dirname, plot_names=None, vector=False, nprocs=None):
+    """Make a grid plot for each distance matrix. By default these are
+    fast raster PNGs (see make_grid_png), made in a pool of nprocs
+    worker processes (default one per CPU). If vector is True, use
+    make_grid instead, which also writes PDF and EPS, but is slow and
+    makes huge files for large matrices."""
     if "depth" in dirname:
         # Assume GP
         if "depth_6" not in dirname:
-            ind_names = open(dirname + "/all_trees.dat").read().strip().split("\n")
-            ind_names = map(lambda x: x.strip(), ind_names)
+            ind_names = tree_index(dirname).trees
         else:
             ind_names = None
     elif "ga_length" in dirname:
@@ -89,14 +94,93 @@ def make_grid_plots(dirname, plot_names=None):
         grph_names, grph_tex_names = graph_distance_names(dirname)
         plot_names = syn_names + grph_names
 
-    for plot_name in plot_names:
-        w = np.genfromtxt(dirname + "/" + plot_name + ".dat")
-        if "depth_6" not in dirname:
-            assert(len(w) == len(ind_names))
-        print plot_name
-        make_grid(w, False, dirname + "/" + plot_name)
+    if "depth_6" not in dirname:
+        n = len(ind_names)
+    else:
+        n = None
+    tasks = [(dirname, plot_name, n) for plot_name in plot_names]
+    if vector:
+        map(_vector_grid_plot, tasks)
+    else:
+        if nprocs is None:
+            nprocs = multiprocessing.cpu_count()
+        if nprocs == 1 or len(tasks) < 2:
+            map(_raster_grid_plot, tasks)
+        else:
+            pool = multiprocessing.Pool(min(nprocs, len(tasks)))
+            try:
+                pool.map(_raster_grid_plot, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
     print ind_names # better to print them in a list somewhere than in the graph
 
+def _vector_grid_plot(task):
+    dirname, plot_name, n = task
+    w = np.genfromtxt(dirname + "/" + plot_name + ".dat")
+    if n is not None:
+        assert(len(w) == n)
+    print plot_name
+    make_grid(w, False, dirname + "/" + plot_name)
+
+def _raster_grid_plot(task):
+    dirname, plot_name, n = task
+    w = load_array(dirname + "/" + plot_name + ".dat")
+    if n is not None:
+        assert(len(w) == n)
+    print plot_name
+    make_grid_png(w, dirname + "/" + plot_name)
+
+def make_grid_png(w, filename, colour_map=None, max_side=2048, min_side=512):
+    """A fast alternative to make_grid: map the matrix w straight to an
+    8-bit PNG, one pixel per cell, with no figure, axes, labels or
+    colour bar. As in make_grid, the smallest value goes to black and
+    the largest to white (with the default grey colour map), and any
+    non-finite values are first replaced by 100 times the largest
+    finite value. A matrix with more than max_side rows or columns is
+    max-pooled down to at most max_side (so isolated large values,
+    eg infinities, stay visible). A small matrix is enlarged by
+    repeating pixels, to at least min_side. w is read a strip of rows
+    at a time, so it can be memory-mapped."""
+
+    nrows, ncols = w.shape
+    # pooling factor
+    f = int(ceil(max(nrows, ncols) / float(max_side)))
+    prows = (nrows + f - 1) // f
+    pcols = (ncols + f - 1) // f
+    pooled = np.empty((prows, pcols))
+    # pooled rows per strip: keep strips to about a million cells
+    strip = max(1, 2**20 // (ncols * f))
+    for r in range(0, prows, strip):
+        block = np.asarray(w[r*f:(r+strip)*f], dtype=float)
+        h = (len(block) + f - 1) // f
+        # pad to a whole number of f x f cells. -inf padding never
+        # wins a max, because every cell contains at least one real
+        # value.
+        padded = np.empty((h * f, pcols * f))
+        padded.fill(-np.inf)
+        padded[:len(block), :ncols] = block
+        pooled[r:r+h] = padded.reshape((h, f, pcols, f)).max(axis=3).max(axis=1)
+
+    is_finite = np.isfinite(pooled)
+    if is_finite.any():
+        map_infinity_to_large(pooled)
+        lo, hi = pooled.min(), pooled.max()
+    else:
+        lo = hi = 0.0
+    if hi > lo:
+        idx = ((pooled - lo) * (255.0 / (hi - lo))).astype(np.uint8)
+    else:
+        idx = np.zeros(pooled.shape, dtype=np.uint8)
+
+    scale = max(1, min_side // max(prows, pcols))
+    if scale > 1:
+        idx = np.repeat(np.repeat(idx, scale, axis=0), scale, axis=1)
+
+    if colour_map is None: colour_map = cm.gray
+    lut = colour_map(np.linspace(0.0, 1.0, 256), bytes=True)
+    plt.imsave(filename + ".png", lut[idx])
+
 def make_grid(w, names, filename, colour_map=None, bar=True):
     # we dont rescale the data. matshow() internally scales the data
     # so that the smallest numbers go to black and largest to white.
@@ -164,7 +248,7 @@ def metric_distortion(a, b):
     avoid divide-by-zero, this assumes d(x, y) != 0 -- ie x != y, and
     d is strictly positive for distinct elements, which is true of any
     metric and all of our non-metric distance functions also. We just
-    overwrite any non-finite values with -1 to exclude the x=y cases.
+    exclude any non-finite ratios, ie the x=y cases.
 
     In our case, X = Y = the search space, eg trees of depth 2 or
     less. d_X is one metric, eg TED; d_Y is another, eg D_TP; f is the
@@ -174,18 +258,10 @@ def metric_distortion(a, b):
     y)/TED(x, y)).
 
     Also, it means that the order of arguments (a, b) is
-    unimportant."""
-
-    old = np.seterr(divide="ignore", invalid="ignore")
-    ab = a/b
-    ab[~np.isfinite(ab)] = -1
-    contraction = np.max(ab)
-    ba = b/a
-    ba[~np.isfinite(ba)] = -1
-    expansion = np.max(ba)
-    distortion = expansion * contraction
-    np.seterr(**old)
-    return distortion
+    unimportant. See distortion_and_rmse() for the calculation."""
+
+    d = {"a": a, "b": b}
+    return distortion_and_rmse(d, [("a", "b")])["a", "b"][0]
 
 def metric_distortion_agreement(a, b):
     # because we want a measure of agreement
@@ -268,36 +344,222 @@ def get_pearson_r(x, y):
     return corr, p
 
 def normalised_rmse(x, y):
-    """Normalise x and y to each have unit stddev, then just take a Euclidean distance."""
-    x = x / np.std(x)
-    y = y / np.std(y)
-    return np.sqrt(np.mean((x-y)**2.0))
+    """Normalise x and y to each have unit stddev, then just take a
+    Euclidean distance. See distortion_and_rmse() for the
+    calculation."""
+    d = {"x": x, "y": y}
+    return distortion_and_rmse(d, [("x", "y")])["x", "y"][1]
+
+def distortion_and_rmse(d, pairs, chunksize=2**18):
+    """For each pair (name1, name2) of flattened distance vectors in
+    d, calculate both the metric distortion and the normalised RMSE
+    (see metric_distortion() and normalised_rmse()).
+
+    Everything is done in a single pass over the data, chunksize
+    entries at a time, so no full-size temporaries are allocated and
+    memory-mapped inputs are fine. Each chunk of each vector is read
+    once and shared by all the pairs it appears in. For the RMSE we
+    want mean((x/sx - y/sy)**2) (sx, sy population stddevs), which is
+    sum((dx - c dy)**2) / (n sx**2) + (mean(x)/sx - mean(y)/sy)**2,
+    with dx, dy deviations from the means and c = sx/sy. Raw sums of
+    squares lose everything when the mean is large relative to the
+    spread, and so does 2(1 - correlation) when x and y are nearly
+    proportional, so instead we keep the means and the sums of
+    squared deviations and co-deviations of x, y and D = x - k y,
+    where k is sx/sy estimated from the first chunk, merging each
+    chunk in with Chan et al's pairwise update (as
+    random_walks._merge_moments). Then sum((dx - c dy)**2) = Mdd +
+    2(k - c) Mdy + (k - c)**2 Myy, where k - c is small. For the
+    distortion we just keep the running maxima of the two ratios.
+
+    Entries which are masked (eg in the estimate_MFPT path) or
+    non-finite in either vector of a pair are excluded from that
+    pair. Return a dict mapping each pair to (distortion, rmse)."""
+
+    N = len(d[pairs[0][0]])
+    # for each pair: k, n, the means of x, y and D = x - k y, and
+    # Mxx, Myy, Mdd, Mdy
+    moments = dict((pair, [None, 0, np.zeros(3), np.zeros(4)]) for pair in pairs)
+    # max(x/y) and max(y/x) for each pair. -1 is what we report when
+    # there are no finite ratios at all.
+    maxes = dict((pair, [-1.0, -1.0]) for pair in pairs)
+
+    def get_chunk(name, start, end):
+        x = d[name][start:end]
+        valid = ~np.ma.getmaskarray(x)
+        x = np.asarray(np.ma.getdata(x), dtype=float)
+        valid &= np.isfinite(x)
+        return x, valid
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for start in range(0, N, chunksize):
+            end = min(N, start + chunksize)
+            chunks = {}
+            for name1, name2 in pairs:
+                for name in name1, name2:
+                    if name not in chunks:
+                        chunks[name] = get_chunk(name, start, end)
+                x, xvalid = chunks[name1]
+                y, yvalid = chunks[name2]
+                valid = xvalid & yvalid
+                x = x[valid]
+                y = y[valid]
+
+                nb = len(x)
+                if nb:
+                    mom = moments[name1, name2]
+                    if mom[0] is None:
+                        sx, sy = x.std(), y.std()
+                        mom[0] = sx / sy if sx > 0 and sy > 0 else 1.0
+                    v = x, y, x - mom[0] * y
+                    mb = np.array([vi.mean() for vi in v])
+                    dx, dy, dd = [vi - mi for vi, mi in zip(v, mb)]
+                    Mb = np.array([np.dot(dx, dx), np.dot(dy, dy),
+                                   np.dot(dd, dd), np.dot(dd, dy)])
+                    na = mom[1]
+                    n = na + nb
+                    e = mb - mom[2]
+                    w = na * nb / float(n)
+                    mom[1] = n
+                    mom[2] = mom[2] + e * nb / float(n)
+                    mom[3] = mom[3] + Mb + w * np.array(
+                        [e[0] * e[0], e[1] * e[1], e[2] * e[2], e[2] * e[1]])
+
+                m = maxes[name1, name2]
+                for i, ratio in enumerate([x / y, y / x]):
+                    ratio = ratio[np.isfinite(ratio)]
+                    if len(ratio):
+                        m[i] = max(m[i], ratio.max())
+
+    results = {}
+    for pair in pairs:
+        k, n, (mx, my, md), (Mxx, Myy, Mdd, Mdy) = moments[pair]
+        contraction, expansion = maxes[pair]
+        distortion = expansion * contraction
+        if n > 0 and Mxx > 0.0 and Myy > 0.0:
+            # population stddevs, as np.std() would give
+            sx = np.sqrt(Mxx / n)
+            sy = np.sqrt(Myy / n)
+            h = k - sx / sy
+            mse = ((Mdd + 2.0 * h * Mdy + h * h * Myy) / (n * sx * sx)
+                   + ((mx * sy - my * sx) / (sx * sy))**2)
+            # can go very slightly negative through rounding
+            rmse = np.sqrt(max(mse, 0.0))
+        else:
+            rmse = np.nan
+        results[pair] = distortion, rmse
+    return results
     
-def make_correlation_tables(dirname):
+def get_association(corr_type, x, y):
+    """Return (corr, p) for a pair of flattened distance vectors x and
+    y, using the given type of correlation. Euclidean and metric
+    distortion have no associated p-value, so we use 1.0 as a
+    placeholder."""
+    if corr_type == "spearmanrho":
+        return get_spearman_rho(x, y)
+    elif corr_type == "kendalltau":
+        return get_kendall_tau(x, y)
+    elif corr_type == "pearsonr":
+        return get_pearson_r(x, y)
+    elif corr_type == "euclidean":
+        return normalised_rmse(x, y), 1.0
+    elif corr_type == "metric_distortion":
+        return metric_distortion_agreement(x, y), 1.0
+    else:
+        raise ValueError("Unknown correlation type " + corr_type)
+
+# The flattened distance vectors used by get_associations(). They are
+# kept at module level so that the worker processes, which are forked
+# after the data has been loaded, share them copy-on-write instead of
+# having them pickled and sent along with every task.
+_association_data = {}
+
+def _association_cell(cell):
+    corr_type, name1, name2 = cell
+    start = time.time()
+    result = get_association(corr_type,
+                             _association_data[name1],
+                             _association_data[name2])
+    return cell, result, time.time() - start
+
+def get_associations(d, cells, nprocs=None):
+    """Calculate the association for each (corr_type, name1, name2)
+    cell, where d maps names to flattened distance vectors. The cells
+    are independent, so they are fanned out to a pool of nprocs
+    worker processes (default one per CPU). Return a dict mapping each
+    cell to (corr, p), and a dict mapping each cell to the number of
+    seconds spent on it."""
+    global _association_data
+    if nprocs is None:
+        nprocs = multiprocessing.cpu_count()
+    # must be set before the pool forks
+    _association_data = d
+    try:
+        if nprocs == 1 or len(cells) < 2:
+            results = map(_association_cell, cells)
+        else:
+            pool = multiprocessing.Pool(min(nprocs, len(cells)))
+            try:
+                # chunksize=1 because cells vary wildly in cost (eg
+                # Kendall's tau versus RMSE)
+                results = pool.map(_association_cell, cells, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        _association_data = {}
+    associations = dict((cell, result) for cell, result, t in results)
+    timings = dict((cell, t) for cell, result, t in results)
+    return associations, timings
+
+def make_correlation_tables(dirname, nprocs=None):
 
     syn_names = syntactic_distance_names(dirname)
     grph_names, grph_tex_names = graph_distance_names(dirname)
 
     d = load_data_and_reshape(dirname, syn_names + grph_names, remap_infinity=True)
 
+    corr_types = []
+    for corr_type in ["spearmanrho", "pearsonr", "kendalltau",
+                      "euclidean", "metric_distortion"]:
+        if corr_type == "kendalltau" and len(d["D_TP"]) > 1000:
+            print("Omitting Kendall tau because it is infeasible for large matrices")
+            continue
+        corr_types.append(corr_type)
+
+    line_names = grph_names + [syn for syn in syn_names if syn != "SEMD"]
+
+    # every cell of every table is independent, so calculate them all
+    # in one go. Euclidean and metric distortion are cheap and come out
+    # of the same pass over the data, so do all their cells together
+    # in one call; everything else goes to the process pool.
+    fused_types = ["euclidean", "metric_distortion"]
+    cells = [(corr_type, graph_distance, dist)
+             for corr_type in corr_types
+             for dist in line_names
+             for graph_distance in grph_names]
+    start = time.time()
+    associations, timings = get_associations(
+        d, [cell for cell in cells if cell[0] not in fused_types], nprocs)
+    if any(corr_type in fused_types for corr_type in corr_types):
+        pairs = [(graph_distance, dist)
+                 for dist in line_names
+                 for graph_distance in grph_names]
+        fused_start = time.time()
+        fused = distortion_and_rmse(d, pairs)
+        # split the time evenly among the cells it covers
+        t = (time.time() - fused_start) / (2.0 * len(pairs))
+        for (graph_distance, dist), (distortion, rmse) in fused.items():
+            associations["euclidean", graph_distance, dist] = rmse, 1.0
+            associations["metric_distortion", graph_distance, dist] = 1.0 / distortion, 1.0
+            timings["euclidean", graph_distance, dist] = t
+            timings["metric_distortion", graph_distance, dist] = t
+    elapsed = time.time() - start
+
     def do_line(dist, dist_name):
         line = dist_name.replace("_TP", r"$_{\mathrm{TP}}$")
         for graph_distance in grph_names:
-            print(corr_type, "getting association between " + graph_distance + " " + dist)
-            if corr_type == "spearmanrho":
-                corr, p = get_spearman_rho(d[graph_distance], d[dist])
-            elif corr_type == "kendalltau":
-                corr, p = get_kendall_tau(d[graph_distance], d[dist])
-            elif corr_type == "pearsonr":
-                corr, p = get_pearson_r(d[graph_distance], d[dist])
-            elif corr_type == "euclidean":
-                # there is no p-value associated with this so use 1.0 as placeholder
-                corr, p = normalised_rmse(d[graph_distance], d[dist]), 1.0
-            elif corr_type == "metric_distortion":
-                # there is no p-value associated with this so use 1.0 as placeholder
-                corr, p = metric_distortion_agreement(d[graph_distance], d[dist]), 1.0
-            else:
-                print("Unknown correlation type " + corr_type)
+            corr, p = associations[corr_type, graph_distance, dist]
             # Consider stat sig only with spearman, kendall, pearson, only
             # with large depth (not looking at entire space)
             if (corr_type in ["spearmanrho", "kendalltau", "pearsonr"] and
@@ -312,11 +574,7 @@ def make_correlation_tables(dirname):
         line += r"\\"
         f.write(line + "\n")
 
-    for corr_type in ["spearmanrho", "pearsonr", "kendalltau",
-                      "euclidean", "metric_distortion"]:
-        if corr_type == "kendalltau" and len(d["D_TP"]) > 1000:
-            print("Omitting Kendall tau because it is infeasible for large matrices")
-            continue
+    for corr_type in corr_types:
         filename = dirname + "/correlation_table_" + corr_type + ".tex"
         f = open(filename, "w")
 
@@ -380,8 +638,18 @@ def make_correlation_tables(dirname):
 """)
         f.close()
 
+    print("Timing summary (seconds of computation per correlation type):")
+    for corr_type in corr_types:
+        t = sum(timings[cell] for cell in cells if cell[0] == corr_type)
+        print("%20s: %4d cells, %8.2f" % (corr_type, len(line_names) * len(grph_names), t))
+    print("%20s: %8.2f seconds wall-clock" % ("total", elapsed))
 
-def load_data_and_reshape(dirname, names, remap_infinity=False):
+
+def load_data_and_reshape(dirname, names, remap_infinity=False, mmap=False):
+    """Read the named matrices from dirname and flatten each one. If
+    mmap is True, the matrices are memory-mapped (see load_array)
+    rather than read in, except in the estimate_MFPT case, which needs
+    masked arrays."""
     d = {}
     for name in names:
         # print("reading " + name)
@@ -399,6 +667,11 @@ def load_data_and_reshape(dirname, names, remap_infinity=False):
             m[mfpte_len < min_vals] = np.ma.masked
 
             # FIXME mask those where MFPT < 0.1?
+        elif mmap:
+            m = load_array(dirname + "/" + name + ".dat")
+            if remap_infinity:
+                # the memory map is read-only
+                m = np.array(m)
         else:
             m = np.genfromtxt(dirname + "/" + name + ".dat")
 
@@ -416,7 +689,7 @@ def make_scatter_plots(dirname):
     grph_names = ["MFPT", "MFPT_VLA"]
     grph_tex_names = ["MFPT", "MFPTV"]
     
-    d = load_data_and_reshape(dirname, syn_names + grph_names)
+    d = load_data_and_reshape(dirname, syn_names + grph_names, mmap=True)
 
     # while we have the data loaded in d, make scatter plots
 
@@ -434,13 +707,25 @@ def make_scatter_plots(dirname):
             continue
             make_scatter_plot(dirname, d, name1, tex_name1, name2, tex_name2)
 
-def make_scatter_plot(dirname, d, name1, tex_name1, name2, tex_name2):
+def make_scatter_plot(dirname, d, name1, tex_name1, name2, tex_name2,
+                      bins=200, hist2d=None):
+    """Scatter-plot two flattened distance matrices against each other.
+    Rather than plotting all n^2 points, the points are binned on a
+    bins x bins grid (see binned_counts) and one point is plotted at
+    the centre of each non-empty bin, so the cost doesn't depend on
+    n. The binned counts can be passed in as hist2d."""
+    if hist2d is None:
+        hists, hists2d = binned_counts(d, [], [(name1, name2)], bins)
+        hist2d = hists2d[name1, name2]
+    counts, xedges, yedges = hist2d
+    xcentres = 0.5 * (xedges[:-1] + xedges[1:])
+    ycentres = 0.5 * (yedges[:-1] + yedges[1:])
+    i, j = np.nonzero(counts)
+
     filename = dirname + "/scatter_" + name1 + "_" + name2
     fig = plt.figure(figsize=(5,5))
     ax = fig.add_subplot(1, 1, 1)
-    xy = deduplicate_rows(np.array([d[name1], d[name2]]).T)
-    x, y = xy.T[0], xy.T[1]
-    ax.scatter(x, y)
+    ax.scatter(xcentres[i], ycentres[j])
     ax.set_xlabel(tex_name1)
     ax.set_ylabel(tex_name2)
     fig.savefig(filename + ".eps", bbox_inches='tight')
@@ -448,28 +733,105 @@ def make_scatter_plot(dirname, d, name1, tex_name1, name2, tex_name2):
     fig.savefig(filename + ".png", bbox_inches='tight')
     plt.close(fig)
 
-def deduplicate_rows(a):
-    """From http://stackoverflow.com/questions/14089453/python-remove-duplicates-from-a-multi-dimensional-array"""
-    return pd.DataFrame(a).drop_duplicates().values
-    
+def _valid_chunk(x, start, end):
+    """Return a chunk of flattened vector x as a float array, with
+    any masked or non-finite values removed, and the boolean array
+    saying which were kept."""
+    x = x[start:end]
+    valid = ~np.ma.getmaskarray(x)
+    x = np.asarray(np.ma.getdata(x), dtype=float)
+    valid &= np.isfinite(x)
+    return x, valid
+
+def get_ranges(d, names, chunksize=2**20):
+    """Return a dict giving (min, max) of the valid values of each of
+    the named flattened vectors in d, reading chunksize values at a
+    time."""
+    ranges = {}
+    for name in names:
+        lo, hi = np.inf, -np.inf
+        for start in range(0, len(d[name]), chunksize):
+            x, valid = _valid_chunk(d[name], start, start + chunksize)
+            x = x[valid]
+            if len(x):
+                lo = min(lo, x.min())
+                hi = max(hi, x.max())
+        if lo > hi:
+            # no valid values at all
+            lo, hi = 0.0, 1.0
+        elif lo == hi:
+            # as np.histogram does
+            lo, hi = lo - 0.5, hi + 0.5
+        ranges[name] = lo, hi
+    return ranges
+
+def binned_counts(d, names, pairs, bins=20, ranges=None, chunksize=2**20):
+    """Calculate 1-D histogram counts for each of the named flattened
+    vectors in d, and 2-D histogram counts for each pair (name1,
+    name2), in a single streaming pass, chunksize values at a time.
+    Memory use is independent of the length of the vectors, so they
+    can be memory-mapped. Masked and non-finite values are excluded
+    (for pairs, if either value is). The bin edges span the range of
+    each vector, which is found by an extra cheap pass (get_ranges)
+    unless ranges, a dict from names to (min, max), is given.
+
+    Return two dicts: from each name to (counts, edges), and from each
+    pair to (counts, xedges, yedges)."""
+    all_names = list(names)
+    for pair in pairs:
+        for name in pair:
+            if name not in all_names:
+                all_names.append(name)
+    if ranges is None:
+        ranges = get_ranges(d, all_names, chunksize)
+    edges = dict((name, np.linspace(ranges[name][0], ranges[name][1], bins + 1))
+                 for name in all_names)
+    hists = dict((name, np.zeros(bins, dtype=int)) for name in names)
+    hists2d = dict((pair, np.zeros((bins, bins), dtype=int)) for pair in pairs)
+
+    N = len(d[all_names[0]]) if all_names else 0
+    for start in range(0, N, chunksize):
+        chunks = dict((name, _valid_chunk(d[name], start, start + chunksize))
+                      for name in all_names)
+        for name in names:
+            x, valid = chunks[name]
+            hists[name] += np.histogram(x[valid], edges[name])[0]
+        for name1, name2 in pairs:
+            x, xvalid = chunks[name1]
+            y, yvalid = chunks[name2]
+            valid = xvalid & yvalid
+            hists2d[name1, name2] += np.histogram2d(
+                x[valid], y[valid], [edges[name1], edges[name2]])[0].astype(int)
+
+    return (dict((name, (hists[name], edges[name])) for name in names),
+            dict(((name1, name2), (hists2d[name1, name2], edges[name1], edges[name2]))
+                 for name1, name2 in pairs))
+
 def make_histograms(dirname):
     syn_names = syntactic_distance_names(dirname)
     grph_names, grph_tex_names = graph_distance_names(dirname)
 
-    d = load_data_and_reshape(dirname, syn_names + grph_names)
+    d = load_data_and_reshape(dirname, syn_names + grph_names, mmap=True)
+
+    # bin everything in one pass, then plot from the bins
+    hists, hists2d = binned_counts(d, grph_names + syn_names, [])
 
     # graph and syn names
     for name, tex_name in zip(grph_names + syn_names, grph_tex_names + syn_names):
-        make_histogram(dirname, d, name, tex_name)
-
-def make_histogram(dirname, d, name, tex_name):
-    if isinstance(d[name], np.ma.core.MaskedArray):
-        data = np.ma.compressed(d[name])
-    else:
-        data = d[name]
+        make_histogram(dirname, d, name, tex_name, hists[name])
+
+def make_histogram(dirname, d, name, tex_name, hist=None):
+    """Plot a histogram of flattened distance matrix d[name] with 20
+    bins. The counts and bin edges (see binned_counts) can be passed
+    in as hist."""
+    if hist is None:
+        hists, hists2d = binned_counts(d, [name], [])
+        hist = hists[name]
+    counts, edges = hist
     fig = plt.figure(figsize=(4, 3))
     ax = fig.add_subplot(1, 1, 1)
-    ax.hist(data, 20, label=tex_name)
+    # one weighted point per bin reproduces the full histogram
+    ax.hist(edges[:-1], edges, weights=counts, label=tex_name)
     ax.set_yticks([])
     # ax.legend()
     fig.savefig(dirname + "/histogram_" + name + ".pdf")
@@ -502,19 +864,15 @@ def compare_TP_estimate_v_exact(dirname):
 
 def compare_MFPT_estimate_RW_v_exact(dirname):
 
-    def get_indices_of_common_entries(a, b):
-        result = []
-        for i in b:
-            try:
-                j = a.index(i)
-                result.append(j)
-            except ValueError:
-                pass
-        assert len(result) == len(b)
-        return result
-
     filename = dirname + "/MFPT.dat"
     mfpt = np.genfromtxt(filename)
+    # the exact standard deviation of each first-passage time, if
+    # written by random_walks.read_and_get_dtp_mfpt_sp_steps
+    filename = dirname + "/MFPT_STD.dat"
+    if os.path.exists(filename):
+        mfpt_std = np.genfromtxt(filename)
+    else:
+        mfpt_std = None
 
     filename = dirname + "/compare_MFPT_estimate_RW_v_exact.tex"
     f = open(filename, "w")
@@ -541,22 +899,32 @@ def compare_MFPT_estimate_RW_v_exact(dirname):
         # indicated by the trees_sampled.dat file
         filename = dirname + "/estimate_MFPT_using_RW_" + str(length) + "/trees_sampled.dat"
         trees_sampled = open(filename).read().strip().split("\n")
-        filename = dirname + "/all_trees.dat"
-        all_trees = open(filename).read().strip().split("\n")
-        indices = get_indices_of_common_entries(all_trees, trees_sampled)
+        indices = tree_index(dirname).lookup(trees_sampled)
         # the selected indices are into both the rows and columns
         mfpt_tmp = mfpt_tmp[indices][:,indices]
+        if mfpt_std is not None:
+            mfpt_std_tmp = mfpt_std[indices][:,indices]
 
         # mfpte will contain the self-hitting time on the diagonal: we
         # want zero there for true comparison.
         set_self_transition_zero(mfpte)
 
+        if mfpt_std is not None:
+            # how many estimates are within two standard errors of the
+            # exact value
+            stderr = mfpt_std_tmp / np.sqrt(np.maximum(mfpte_len, 1))
+            within = np.abs(mfpte - mfpt_tmp) <= 2 * stderr
+            np.fill_diagonal(within, True)
+            ok, total = np.sum(within), np.sum(~np.ma.getmaskarray(within))
+
         # reshape both
         mfpte = mfpte.reshape(len(mfpte)**2)
         mfpt_tmp = mfpt_tmp.reshape(len(mfpt_tmp)**2)
 
         # correlate using mask
         f.write("Number of samples: " + str(length) + "\n")
+        if mfpt_std is not None:
+            f.write("%d of %d estimates within two standard errors of the exact MFPT. " % (ok, total))
         corr, p = get_pearson_r(mfpt_tmp, mfpte)
         f.write("Pearson R correlation " + str(corr) + "; ")
         f.write("p-value " + str(p) + ". ")
@@ -633,10 +1001,12 @@ def write_steady_state(dirname):
     s = ("Detailed balance check: " + str(random_walks.detailed_balance(tp, ss)))
     open(dirname + "/detailed_balance.tex", "w").write(s)
 
-def make_mds_images(dirname, names=None):
+def make_mds_images(dirname, names=None, method="smacof", nprocs=None):
     """Make MDS images for multiple distance matrices. Each matrix
     must be symmetric. Must not contain any infinities, which prevents
-    SD_TP in a space like ga_length_4_per_ind."""
+    SD_TP in a space like ga_length_4_per_ind. The embeddings are
+    calculated in parallel, using the given method (see
+    embedding.methods), and cached."""
 
     if "depth" in dirname:
         if names is None:
@@ -654,36 +1024,34 @@ def make_mds_images(dirname, names=None):
         if names is None:
             names = ["CT", "SD_TP", "FE", "KendallTau"]
         labels = None
-    for name in names:
-        m = np.genfromtxt(dirname + "/" + name + ".dat")
-        make_mds_image(m, dirname + "/" + name + "_MDS", labels)
+    filenames = [dirname + "/" + name + ".dat" for name in names]
+    ps = embedding.embed_files(filenames, method,
+                               dirname + "/embedding_cache", nprocs)
+    for name, p in zip(names, ps):
+        if p is None:
+            continue
+        filename = dirname + "/" + name + "_MDS"
+        np.savetxt(filename + ".dat", p)
+        draw_mds_image(p, filename, labels)
 
-def make_mds_image(m, filename, labels=None, colour=None):
+def make_mds_image(m, filename, labels=None, colour=None, method="smacof"):
     """Given a matrix of distances, project into 2D space using
-    multi-dimensional scaling and produce an image."""
+    multi-dimensional scaling and produce an image. The embedding is
+    cached (see embedding.get_embedding) and also written to
+    filename.dat."""
 
     mds_data_filename = filename + ".dat"
-
+    cache_dir = os.path.join(os.path.dirname(filename), "embedding_cache")
     try:
-        # if we've previously computed, load it
-        p = np.genfromtxt(mds_data_filename)
-    except:
-        # else, compute it now (and save)
-        
-        # Construct MDS object with various defaults including 2d
-        mds = MDS(dissimilarity="precomputed")
-        # Fit
-        try:
-            f = mds.fit(m)
-        except ValueError as e:
-            print("Can't run MDS for " + filename + ": " + str(e))
-            return
-
-        # Get the embedding in 2d space
-        p = f.embedding_
+        p = embedding.get_embedding(m, method, cache_dir)
+    except ValueError as e:
+        print("Can't run MDS for " + filename + ": " + str(e))
+        return
+    np.savetxt(mds_data_filename, p)
+    draw_mds_image(p, filename, labels)
 
-        # save
-        np.savetxt(mds_data_filename, p)
+def draw_mds_image(p, filename, labels=None):
+    """Make an image of points p, an embedding in 2D space."""
 
     # Make an image
     fig, ax = plt.subplots(figsize=(5, 5))
@@ -725,7 +1093,7 @@ def new_ocean():
 
 def make_UCD_research_images():
     dirname = "../../results/depth_2/"
-    tree_names = open("../../results/depth_2/all_trees.dat").read().strip().split("\n")
+    tree_names = tree_index("../../results/depth_2").trees
 
     # names = ["TED", "OVD", "CT", "FVD", "FE", "SD_TP", "TAD0", "TAD2"]
     names = ["OVD", "FE", "SD_TP", "TED"]
@@ -794,21 +1162,6 @@ def make_SIGEvo_images():
     def count_ones(i):
         # count ones in the binary rep
         return bin(i).count("1")
-    def tsp_fit(t):
-        def d(a, b): return sqrt((a[0]-b[0])**2.0 + (a[1]-b[1])**2.0)
-        # place a few arbitrary cities
-        c = [[0, 0],
-             [10, 1],
-             [5, 5],
-             [2, 8],
-             [8, 9],
-             [5, 9],
-             [7, 1]
-        ]
-        s = t + (t[0],) # replicate initial city to make it easy
-        return sum(d(c[s[i]], c[s[i+1]]) for i in range(len(t)))
-        
-    
     names = ["OVD", "FE", "SD_TP", "TED", "TAD1", "FVD", "CT", "SEMD", "Hamming", "SEMD_alternate_target", "KendallTau"]
     colour_maps = [new_ocean(), cm.PuRd_r, cm.YlOrRd, cm.copper, cm.autumn, cm.Purples_r, cm.YlGnBu_r, cm.summer, cm.BuGn_r, cm.afmhot, cm.BuPu_r]
 
@@ -829,18 +1182,18 @@ def make_SIGEvo_images():
             # TSP
             mds_data_filename = tsp_dirname + "/" + name + "_MDS.dat"
             mds_output_filename = tsp_dirname + "/SIGEvo_images/" + name + "_MDS"
-            colour_vals = [tsp_fit(t) for t in tsp_tours(7)] # will be scaled
+            colour_vals = tsp_fitvals(7) # will be scaled
             marker_sizes = [30 for i in range(len(colour_vals))]
             marker = 'o' # circle
 
         else:
             # GP
-            tree_names = open("../../results/depth_2/all_trees.dat").read().strip().split("\n")
+            tree_names = tree_index("../../results/depth_2").trees
 
             if name == "SEMD_alternate_target":
-                fit_vals = np.genfromtxt("../../results/depth_2/all_trees_fitness_alternate_target.dat")
+                fit_vals = load_array("../../results/depth_2/all_trees_fitness_alternate_target.dat")
             else:
-                fit_vals = np.genfromtxt("../../results/depth_2/all_trees_fitness.dat")
+                fit_vals = load_array("../../results/depth_2/all_trees_fitness.dat")
             mds_data_filename = gp_dirname + "/SEMD_MDS.dat" # not SEMD_alternate_target -- no need
             mds_output_filename = gp_dirname + "/SIGEvo_images/" + name + "_MDS"
             colour_vals = [colour_val(i) for i in range(len(tree_names))]
@@ -878,10 +1231,16 @@ if __name__ == "__main__":
         make_grid_plots(dirname)
     elif cmd == "makeGridPlotsByName":
         make_grid_plots(dirname, sys.argv[3:])
+    elif cmd == "makeGridPlotsVector":
+        make_grid_plots(dirname, vector=True)
     elif cmd == "writeSteadyState":
         write_steady_state(dirname)
     elif cmd == "makeMDSImages":
-        make_mds_images(dirname)
+        if len(sys.argv) > 3:
+            # method, eg classical or pivot
+            make_mds_images(dirname, method=sys.argv[3])
+        else:
+            make_mds_images(dirname)
     elif cmd == "makeMDSImagesByName":
         make_mds_images(dirname, sys.argv[3:])
     elif cmd == "makeScatterPlots":
@@ -8,11 +8,15 @@ probabilities as high edge traversal costs) and the shortest path (in
 number of steps, disregarding probabilities)."""
 
 import numpy as np
-import scipy.stats, scipy.misc
+import scipy.stats, scipy.misc, scipy.sparse, scipy.sparse.linalg
 import random
 import sys
 import os
 import itertools
+import math
+import hashlib
+import weakref
+import multiprocessing
 from collections import OrderedDict
 import matplotlib.pyplot as plt
 import cPickle as pickle
@@ -24,33 +28,144 @@ import cPickle as pickle
 # J. Laurie Snell (1976) Finite Markov Chains. Springer-Verlag,
 # Berlin.
 import ergodic
+import markov
+
+def _random_walk_sample_blocks(f, chunksize=2**22):
+    """Parse a file of lines "tree i:tree j:samples", where samples
+    are space-separated ints, reading chunksize bytes at a time.
+    Generate (tree i, tree j, array) for each line, where a line
+    longer than a chunk comes as several arrays, so memory use doesn't
+    depend on line length. The ints are parsed by np.fromstring,
+    not one at a time."""
+    buf = ""
+    header = None
+    done = False
+    while not done:
+        data = f.read(chunksize)
+        done = not data
+        buf += data
+        pos = 0
+        while True:
+            if header is None:
+                nl = buf.find("\n", pos)
+                c1 = buf.find(":", pos)
+                if nl >= 0 and (c1 < 0 or nl < c1):
+                    # blank line
+                    pos = nl + 1
+                    continue
+                c2 = buf.find(":", c1 + 1) if c1 >= 0 else -1
+                if c2 < 0:
+                    break
+                header = buf[pos:c1].strip(), buf[c1 + 1:c2].strip()
+                pos = c2 + 1
+            nl = buf.find("\n", pos)
+            if nl >= 0 or done:
+                end = nl if nl >= 0 else len(buf)
+                yield header + (np.fromstring(buf[pos:end], dtype=np.int64, sep=" "),)
+                header = None
+                pos = end + 1
+                if pos >= len(buf):
+                    break
+            else:
+                # part of a long line: parse up to the last complete int
+                sp = buf.rfind(" ", pos)
+                if sp > pos:
+                    yield header + (np.fromstring(buf[pos:sp], dtype=np.int64, sep=" "),)
+                    pos = sp
+                break
+        buf = buf[pos:]
+
+def _merge_moments(a, b):
+    """Merge (count, mean, M2) for two sets of samples, where M2 is
+    the sum of squared deviations from the mean (Chan et al's
+    pairwise version of Welford's update)."""
+    na, ma, m2a = a
+    nb, mb, m2b = b
+    n = na + nb
+    if n == 0:
+        return a
+    delta = mb - ma
+    return (n, ma + delta * nb / float(n), m2a + m2b + delta * delta * na * nb / float(n))
+
+def read_random_walk_samples(filename, chunksize=2**22, trees=None):
+    """Read a file of random-walk samples as written by the Java code
+    (see _random_walk_sample_blocks) in a single pass and constant
+    memory, however large, keeping the count, mean and M2 of each
+    (tree i, tree j) pair. Returns the trees, and the matrices of
+    mean, standard deviation and number of samples (nan where a pair
+    has no samples), indexed by the position of tree i and tree j
+    among them. The trees are in order of first appearance, unless
+    trees is given: a list (eg trees_sampled.dat) gives the order
+    exactly, and every sampled tree must be in it (KeyError
+    otherwise), while a TreeIndex gives the sampled trees in the order
+    of its rows."""
+    stats = {}
+    ids = OrderedDict()
+    with open(filename) as f:
+        for t0, t1, x in _random_walk_sample_blocks(f, chunksize):
+            t0, t1 = normalise_tree_string(t0), normalise_tree_string(t1)
+            ids.setdefault(t0, len(ids))
+            ids.setdefault(t1, len(ids))
+            if len(x):
+                mean = x.mean()
+                b = (len(x), mean, ((x - mean) ** 2).sum())
+            else:
+                b = (0, 0.0, 0.0)
+            key = ids[t0], ids[t1]
+            stats[key] = _merge_moments(stats[key], b) if key in stats else b
+    seen = list(ids)
+    if trees is None:
+        trees = seen
+    elif isinstance(trees, TreeIndex):
+        trees = [trees.trees[i] for i in np.unique(trees.lookup(seen))]
+    else:
+        trees = [normalise_tree_string(t) for t in trees]
+    pos = TreeIndex(trees).lookup(seen)
+    n = len(trees)
+    x_mean = np.nan * np.ones((n, n))
+    x_std = np.nan * np.ones((n, n))
+    x_len = np.zeros((n, n), dtype=int)
+    for (i, j), (k, mean, m2) in stats.items():
+        i, j = pos[i], pos[j]
+        x_len[i, j] = k
+        if k:
+            x_mean[i, j] = mean
+            x_std[i, j] = np.sqrt(m2 / k)
+    return trees, x_mean, x_std, x_len
 
 def analyse_random_walk(dirname):
     """Java code will write out a list of sampled lengths of random
     walks between nodes i and j. A single file, each line containing
-    the tree i, tree j, then the list of samples. Analyse the
-    basics."""
-
-    n = 20
-    f = open(dirname + "/MFPT_random_walking_samples.dat")
-    x_mean = np.zeros((n, n))
-    x_var = np.zeros((n, n))
-    x_len = np.zeros((n, n), dtype=int)
-    i = 0
-    j = 0
-    for line in f:
-        t0, t1, samples = line.split(":")
-        samples = np.array(map(int, samples.strip().split(" ")))
-        x_mean[i, j] = np.mean(samples)
-        x_var[i, j] = np.std(samples)
-        x_len[i, j] = len(samples)
-        i += 1
-        if i == n:
-            i = 0
-            j += 1
+    the tree i, tree j, then the list of samples. Write the mean,
+    standard deviation and number of samples for each pair out as
+    MFPTE.dat, MFPTE_STD.dat and MFPTE_len.dat. As with the Java code
+    (Sample.java), rows and columns are in the order of
+    trees_sampled.dat if there is one, and otherwise the sampled trees
+    are in the order of all_trees.dat and are written out as
+    trees_sampled.dat. If the directory has the exact MFPT_STD.dat
+    (see read_and_get_dtp_mfpt_sp_steps) as well as MFPT.dat, print
+    the exact mean and standard deviation alongside."""
+
+    sampled_filename = dirname + "/trees_sampled.dat"
+    if os.path.exists(sampled_filename):
+        order = open(sampled_filename).read().strip().split("\n")
+    else:
+        order = tree_index(dirname)
+    trees, x_mean, x_std, x_len = read_random_walk_samples(
+        dirname + "/MFPT_random_walking_samples.dat", trees=order)
+    np.savetxt(dirname + "/MFPTE.dat", x_mean)
+    np.savetxt(dirname + "/MFPTE_STD.dat", x_std)
+    np.savetxt(dirname + "/MFPTE_len.dat", x_len, fmt="%d")
+    if not os.path.exists(sampled_filename):
+        open(sampled_filename, "w").write("\n".join(trees) + "\n")
     print(x_mean)
-    print(x_var)
+    print(x_std)
     print(x_len)
+    if (os.path.exists(dirname + "/MFPT.dat")
+        and os.path.exists(dirname + "/MFPT_STD.dat")):
+        idx = tree_index(dirname).lookup(trees)
+        print(load_array(dirname + "/MFPT.dat")[idx][:, idx])
+        print(load_array(dirname + "/MFPT_STD.dat")[idx][:, idx])
 
 def estimate_MFPT_with_supernode(dirname):
     """Given a directory, go in there and get all the files under
@@ -60,7 +175,7 @@ def estimate_MFPT_with_supernode(dirname):
     values and the values calculated by exact MFPT given the complete
     TP matrix."""
     n = 50
-    all_trees = open(dirname + "/all_trees.dat").read().strip().split("\n")
+    all_trees = tree_index(dirname)
     estimate = np.zeros(2 * n)
     exact = np.genfromtxt(dirname + "/MFPT.dat")
     exact_extract = np.zeros(2 * n)
@@ -72,8 +187,7 @@ def estimate_MFPT_with_supernode(dirname):
         m = get_mfpt(d)
         t, s = open(dirname + "/TP_supernode_estimates/"
                     + str(i) + "_trees.dat").read().strip().split("\n")
-        ti = all_trees.index(t)
-        si = all_trees.index(s)
+        ti, si = all_trees.lookup([t, s])
         estimate[2*i] = m[0, 1]
         estimate[2*i+1] = m[1, 0]
         exact_extract[2*i] = exact[ti, si]
@@ -166,19 +280,23 @@ def MSTP_wrapper(dirname):
         dmstp = -np.log(mstp)
         np.savetxt(dirname + "/D_MSTP_" + str(i) + ".dat", dmstp)
 
-def MSTP_max_n_steps(x, n=10):
+def MSTP_max_n_steps(x, n=10, chain=None):
     """The probability of reaching state j, starting from state i, in
     n steps or fewer. Loops are allowed, hence even if n > number of
-    states, these probabilities don't reach 1 in general."""
-    L = len(x)
-    mstp = np.eye(L)
-    for i in range(L):
-        xi = x.copy()
-        make_absorbing(xi, i)
-        # the ith column is copied from the ith column of A^n, where A
-        # is absorbing in state i
-        mstp[:, i] = np.linalg.matrix_power(xi, n)[:, i]
-        print i
+    states, these probabilities don't reach 1 in general. If x has
+    detailed balance, this comes from its eigenpairs: pass chain (see
+    reversible_chain) to reuse an eigendecomposition. x may be
+    scipy.sparse."""
+    if chain is None:
+        chain = reversible_chain(x)
+    if chain is not None:
+        return chain.mstp(n)
+    # otherwise, the probability of not having hit each j yet,
+    # propagated for all j at once (see markov.taboo_survival)
+    for t, H in markov.taboo_survival(x, range(x.shape[0]), n):
+        pass
+    mstp = 1.0 - H
+    np.fill_diagonal(mstp, 1.0)
     return mstp
 
 def read_transition_matrix(filename):
@@ -187,6 +305,127 @@ def read_transition_matrix(filename):
     d = np.genfromtxt(filename)
     return d
 
+def load_array(filename, mmap_mode="r"):
+    """Read an array written out as text by np.savetxt, eg one of the
+    .dat matrices. The first time, a binary copy is saved alongside it
+    (same name, .npy extension), and from then on that is loaded
+    instead, memory-mapped unless mmap_mode is None. This is much
+    faster than genfromtxt, and lets large matrices be processed a
+    block at a time without reading them into memory. The .npy is
+    regenerated if the .dat is newer. If there is only a .npy, it is
+    used directly."""
+    npy_filename = os.path.splitext(filename)[0] + ".npy"
+    if os.path.exists(filename):
+        if (not os.path.exists(npy_filename) or
+            os.path.getmtime(npy_filename) < os.path.getmtime(filename)):
+            np.save(npy_filename, np.genfromtxt(filename))
+    return np.load(npy_filename, mmap_mode=mmap_mode)
+
+def normalise_tree_string(t):
+    """Collapse runs of whitespace, and strip it from the ends, so that
+    a tree written by the Java code, by generate_trees, or with a
+    trailing \\r all look the same."""
+    return " ".join(t.split())
+
+class TreeIndex(object):
+    """The trees of a results directory, in the order of the rows and
+    columns of its matrices (ie all_trees.dat), with a hash map from
+    tree string (see normalise_tree_string) to row."""
+
+    def __init__(self, trees):
+        self.trees = [normalise_tree_string(t) for t in trees]
+        # as list.index, a repeated tree maps to its first row
+        self.ids = {}
+        for i, t in enumerate(self.trees):
+            if t not in self.ids:
+                self.ids[t] = i
+
+    def __len__(self):
+        return len(self.trees)
+
+    def __contains__(self, t):
+        return normalise_tree_string(t) in self.ids
+
+    def __getitem__(self, t):
+        return self.ids[normalise_tree_string(t)]
+
+    def lookup(self, trees):
+        """The rows of many trees at once, as an int array. Raises
+        KeyError if any is missing."""
+        ids = self.ids
+        return np.array([ids[normalise_tree_string(t)] for t in trees], dtype=int)
+
+# TreeIndex of each all_trees.dat read so far, by absolute filename,
+# with the modification time it was read at.
+_tree_indexes = {}
+
+def tree_index(dirname):
+    """Return the TreeIndex for dirname/all_trees.dat. As load_array,
+    the first time a binary copy is saved alongside it (all_trees.pkl)
+    and loaded from then on, and regenerated if all_trees.dat is
+    newer. The result is also cached in-process, so every stage
+    shares one copy."""
+    filename = os.path.abspath(os.path.join(dirname, "all_trees.dat"))
+    pkl_filename = os.path.splitext(filename)[0] + ".pkl"
+    if os.path.exists(filename):
+        mtime = os.path.getmtime(filename)
+    else:
+        mtime = os.path.getmtime(pkl_filename)
+    cached = _tree_indexes.get(filename)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    if os.path.exists(filename) and (not os.path.exists(pkl_filename) or
+                                     os.path.getmtime(pkl_filename) < mtime):
+        idx = TreeIndex(open(filename).read().strip().split("\n"))
+        pickle.dump(idx.trees, open(pkl_filename, "wb"), pickle.HIGHEST_PROTOCOL)
+    else:
+        idx = TreeIndex(pickle.load(open(pkl_filename, "rb")))
+    _tree_indexes[filename] = (mtime, idx)
+    return idx
+
+def array_hash(a, blocksize=2**22):
+    """Return a hex digest identifying the contents, shape and dtype of
+    array a, for use as a cache key. Large (eg memory-mapped) arrays
+    are hashed a block of rows at a time."""
+    h = hashlib.sha1()
+    h.update(str(a.shape) + str(a.dtype))
+    if a.ndim == 0 or a.size == 0:
+        h.update(np.ascontiguousarray(a).tobytes())
+    else:
+        rows = max(1, blocksize // max(1, a[0].size))
+        for start in range(0, len(a), rows):
+            h.update(np.ascontiguousarray(a[start:start+rows]).tobytes())
+    return h.hexdigest()
+
+# Fitness values loaded so far, keyed by directory
+_fitvals = {}
+
+def fitness_vals(dirname):
+    """Return the fitness of every individual in the space in dirname,
+    in the order of the matrices. GA and TSP values are generated
+    (vectorised) the first time and saved as fitness_vals.npy. GP
+    values are the all_trees_fitness file written from the enumerated
+    semantics by generate_trees.py. All are loaded memory-mapped via
+    load_array, and kept, so experiments share one copy."""
+    dirname = os.path.normpath(dirname)
+    if dirname not in _fitvals:
+        base = os.path.basename(dirname)
+        if "depth" in base:
+            filename = os.path.join(dirname, "all_trees_fitness.dat")
+        else:
+            filename = os.path.join(dirname, "fitness_vals.dat")
+            npy_filename = os.path.splitext(filename)[0] + ".npy"
+            if not (os.path.exists(filename) or os.path.exists(npy_filename)):
+                length = int(base.split("_")[2])
+                if base.startswith("ga"):
+                    np.save(npy_filename, onemax_fitvals(length))
+                elif base.startswith("tsp"):
+                    np.save(npy_filename, tsp_fitvals(length))
+                else:
+                    raise ValueError("Don't know how to make fitness values for " + dirname)
+        _fitvals[dirname] = load_array(filename)
+    return _fitvals[dirname]
+
 def check_row_sums(d):
     """Check that each row sums to 1, since each row is the
     out-probabilities from a single individual. Allow the small margin
@@ -217,10 +456,19 @@ def set_self_transition_zero(x):
     """Set cost/length of self-transition to zero."""
     np.fill_diagonal(x, 0.0)
 
-def get_mfpt(x):
+def get_mfpt(x, chain=None):
     """Calculate mean-first-passage time of a given transition
     matrix. Set self-transitions to zero. Note that the pysal code
-    (ergodic.py) calls it "first-mean-passage-time"."""
+    (ergodic.py) calls it "first-mean-passage-time". If x has detailed
+    balance, this comes from its eigenpairs: pass chain (see
+    reversible_chain) to reuse an eigendecomposition."""
+    if hasattr(x, "mfpt"):
+        # a structured operator (see implicit_operators.py)
+        return x.mfpt()
+    if chain is None:
+        chain = reversible_chain(x)
+    if chain is not None:
+        return chain.mfpt()
     # NB! The ergodic code expects a matrix, not a numpy array. Breaks
     # otherwise.
     x = np.matrix(x)
@@ -228,6 +476,17 @@ def get_mfpt(x):
     set_self_transition_zero(x)
     return x
 
+def get_mfpt_and_std(x):
+    """Mean-first-passage time, as get_mfpt, and the standard
+    deviation of the first-passage time, both from one fundamental
+    matrix (see ergodic.first_passage_moments). Both are zero on the
+    diagonal."""
+    m, m2 = ergodic.first_passage_moments(np.asarray(x), 2)
+    std = np.sqrt(np.maximum(m2 - m * m, 0.0))
+    set_self_transition_zero(m)
+    set_self_transition_zero(std)
+    return m, std
+
 def test_matrix_size(n):
     """Test how big the tm can be before get_mfpt becomes
     slow. n = 4000 is fine, n = 10000 starts paging out (at least 30
@@ -334,6 +593,8 @@ def get_steady_state(tp):
     representing how long the system will spend in each state in the
     long run. If not uniform, that is a bias imposed by the operator
     on the system."""
+    if hasattr(tp, "steady_state"):
+        return tp.steady_state()
     import ergodic
     ss = np.array(ergodic.steady_state(np.matrix(tp)))
     ss = np.real(ss) # discard zero imaginary parts
@@ -369,10 +630,12 @@ def read_and_get_dtp_mfpt_sp_steps(dirname):
     np.savetxt(outfilename, d)
 
     # This gets the mean first passage time, ie the expected length of
-    # a random walk.
-    f = get_mfpt(t)
+    # a random walk, and its standard deviation.
+    f, f_std = get_mfpt_and_std(t)
     outfilename = dirname + "/MFPT.dat"
     np.savetxt(outfilename, f)
+    outfilename = dirname + "/MFPT_STD.dat"
+    np.savetxt(outfilename, f_std)
 
     # This gets the cost of the shortest path between pairs. The cost
     # of an edge is the negative log of its probability.
@@ -437,9 +700,17 @@ def Krovi_Brun_bitstring_MFPT(n, d):
         sum(nCk(n, k) for k in range(m+1)) / float(nCk(n-1, m))
         for m in range(n-d, n))
 
+# Number of ones in each byte value
+_popcount8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
 def onemax_fitvals(length):
-    return [np.sum(ind) for ind in
-            itertools.product(*[(0, 1) for x in range(length)])]
+    """OneMax fitness of every bitstring of the given length, in the
+    order of itertools.product, ie the popcount of each index."""
+    i = np.arange(2**length, dtype=np.int64)
+    result = np.zeros(len(i), dtype=np.int64)
+    for shift in range(0, length, 8):
+        result += _popcount8[(i >> shift) & 255]
+    return result
 
 def ga_tm_wrapper(dirname, pmut=None):
     # dirname should be <dir>/ga_length_6, for example
@@ -548,7 +819,10 @@ def hillclimb(tp, fitvals, steps, rw=False):
     fitness_samples = []
     fitval = fitvals[s]
     for i in range(steps):
-        t = roulette_wheel(tp[s])
+        if hasattr(tp, "sample_neighbour"):
+            t = tp.sample_neighbour(s)
+        else:
+            t = roulette_wheel(tp[s])
         if rw:
             s = t
             fitval = fitvals[t]
@@ -561,6 +835,105 @@ def hillclimb(tp, fitvals, steps, rw=False):
         fitness_samples.append(fitval)
     return samples, fitness_samples, fitval
 
+def hillclimb_matrix(tp, fitvals, rw=False):
+    """The transition matrix of the chain followed by hillclimb: a move
+    from s to t proposed by tp is accepted if fitvals[t] > fitvals[s],
+    and otherwise we stay at s. If rw, every move is accepted, so this
+    is just tp. Works on dense or scipy.sparse tp."""
+    if rw:
+        return tp
+    fitvals = np.asarray(fitvals)
+    if scipy.sparse.issparse(tp):
+        P = tp.tocoo()
+        keep = fitvals[P.col] > fitvals[P.row]
+        P = scipy.sparse.csr_matrix((P.data[keep], (P.row[keep], P.col[keep])), shape=tp.shape)
+        rejected = 1.0 - np.asarray(P.sum(1)).ravel()
+        return P + scipy.sparse.diags(rejected)
+    P = np.where(fitvals[np.newaxis, :] > fitvals[:, np.newaxis], tp, 0.0)
+    P[np.diag_indices_from(P)] += 1.0 - P.sum(1)
+    return P
+
+def _step_distribution(P, q):
+    """One step of a chain: the row vector q times P."""
+    return P.T.dot(q)
+
+def hillclimb_distributions(tp, fitvals, steps, rw=False, p0=None):
+    """The exact distribution of the state of hillclimb after 0, 1,
+    ..., steps steps, starting from p0 (uniform by default, as
+    hillclimb). Returns an array with one row per step."""
+    P = hillclimb_matrix(tp, fitvals, rw)
+    n = tp.shape[0]
+    q = np.ones(n) / n if p0 is None else np.asarray(p0, dtype=float)
+    result = [q]
+    for i in range(steps):
+        q = _step_distribution(P, q)
+        result.append(q)
+    return np.array(result)
+
+def hillclimb_expected_fitness(tp, fitvals, steps, rw=False):
+    """The mean and stddev of the fitness returned by hillclimb (the
+    fitness of the final state, ie the best for a hill-climb), without
+    sampling."""
+    fitvals = np.asarray(fitvals, dtype=float)
+    q = hillclimb_distributions(tp, fitvals, steps, rw)[-1]
+    mu = q.dot(fitvals)
+    return mu, np.sqrt(max(q.dot(fitvals**2) - mu**2, 0.0))
+
+def encounter_probability(tp, fitvals, steps, target, rw=False):
+    """The probability that target is among the samples of hillclimb,
+    ie visited in steps 1 to steps, from a uniform start. The first
+    step is taken as normal (so the start state isn't counted unless
+    the walk stays there), then the target is made absorbing and the
+    mass absorbed is counted."""
+    P = hillclimb_matrix(tp, fitvals, rw)
+    n = tp.shape[0]
+    q = _step_distribution(P, np.ones(n) / n)
+    hit = 0.0
+    for i in range(steps):
+        if i > 0:
+            q = _step_distribution(P, q)
+        hit += q[target]
+        q[target] = 0.0
+    return hit
+
+def expected_distinct_samples(tp, fitvals, steps, rw=False):
+    """The expected number of distinct states among the samples of
+    hillclimb: the sum over states of the probability of encountering
+    them, calculated for all states at once. Row j of Q is the
+    distribution of the walk with state j made absorbing as in
+    encounter_probability."""
+    P = hillclimb_matrix(tp, fitvals, rw)
+    n = tp.shape[0]
+    if scipy.sparse.issparse(P):
+        P = P.toarray()
+    Q = np.tile(_step_distribution(P, np.ones(n) / n), (n, 1))
+    hit = np.zeros(n)
+    diag = np.diag_indices(n)
+    for i in range(steps):
+        if i > 0:
+            Q = np.dot(Q, P)
+        hit += Q[diag]
+        Q[diag] = 0.0
+    return hit.sum()
+
+def test_hillclimb_exact(tp, fitvals, steps=50, reps=2000):
+    """Cross-check the exact calculations against hillclimb."""
+    for rw in [False, True]:
+        best = []
+        hits = 0.0
+        distinct = []
+        for rep in range(reps):
+            samples, fit_samples, fitval = hillclimb(tp, fitvals, steps, rw)
+            best.append(fitval)
+            hits += 0 in samples
+            distinct.append(len(set(samples)))
+        print("rw=%s fitness: exact %s, Monte Carlo %s" % (
+            rw, hillclimb_expected_fitness(tp, fitvals, steps, rw), (np.mean(best), np.std(best))))
+        print("rw=%s encounter state 0: exact %.4f, Monte Carlo %.4f" % (
+            rw, encounter_probability(tp, fitvals, steps, 0, rw), hits / reps))
+        print("rw=%s distinct samples: exact %.3f, Monte Carlo %.3f" % (
+            rw, expected_distinct_samples(tp, fitvals, steps, rw), np.mean(distinct)))
+
 def generate_oz_tm_mfpte(dirname):
     tp = land_of_oz_matrix()
     samples = simulate_random_walk(
@@ -574,8 +947,166 @@ def generate_oz_tm_mfpte(dirname):
     np.savetxt(dirname + "/MFPTE.dat", mfpte)
     np.savetxt(dirname + "/MFPTE_STD.dat", mfpte_std)
 
+# Memoised results of uniformify and mu_sigma, least recently used
+# first. They're keyed by the identity of the matrix (and p): hashing
+# the contents would cost more than uniformify itself. Each entry
+# holds a weak reference to the matrix, to detect a recycled id.
+_uniformified = OrderedDict()
+_log_tp = OrderedDict()
+_mu_sigma = OrderedDict()
+uniformify_cache_size = 32
+
+def _memo_get(cache, t, p=None):
+    """Look up (t, p) in an LRU cache (an OrderedDict, as
+    _uniformified), or return None. t is an array or matrix, matched
+    by identity, and p any hashable parameter, so t mustn't be
+    modified while it's cached."""
+    key = (id(t), p)
+    entry = cache.pop(key, None)
+    if entry is None or entry[0]() is not t:
+        return None
+    cache[key] = entry
+    return entry[1]
+
+def _memo_put(cache, t, p, value):
+    """Store value for (t, p) in an LRU cache, dropping the least
+    recently used entries past uniformify_cache_size, and return
+    it."""
+    cache[(id(t), p)] = (weakref.ref(t), value)
+    while len(cache) > uniformify_cache_size:
+        cache.popitem(last=False)
+    return value
+
 def uniformify(tp, p):
-    return (tp**p) / (np.sum(tp**p, 1).reshape((len(tp), 1)))
+    """Raise each transition probability to the power p and
+    renormalise each row: p < 1 makes the walk more uniform, p > 1
+    less. tp**p is calculated as exp(p * log(tp)), with log(tp)
+    calculated once per matrix and shared by all values of p, and the
+    row normalisation done in place. Results are memoised by (matrix,
+    p), so they're shared and read-only, and tp mustn't be modified
+    in place afterwards. If tp is a scipy.sparse matrix, only its
+    nonzeros are touched, and the result is a CSR matrix. Structured
+    operators (see implicit_operators.py) do it themselves."""
+    if hasattr(tp, "uniformify"):
+        return tp.uniformify(p)
+    result = _memo_get(_uniformified, tp, p)
+    if result is not None:
+        return result
+
+    log_tp = _memo_get(_log_tp, tp)
+    if log_tp is None:
+        if scipy.sparse.issparse(tp):
+            log_tp = tp.tocsr().copy()
+            log_tp.sum_duplicates()
+            log_tp.eliminate_zeros()
+            log_tp.data = np.log(log_tp.data)
+        else:
+            with np.errstate(divide="ignore"):
+                log_tp = np.log(tp)
+        _memo_put(_log_tp, tp, None, log_tp)
+
+    if scipy.sparse.issparse(tp):
+        result = log_tp.copy()
+        np.multiply(result.data, p, out=result.data)
+        np.exp(result.data, out=result.data)
+        sums = np.asarray(result.sum(1)).ravel()
+        result.data /= np.repeat(sums, np.diff(result.indptr))
+    else:
+        with np.errstate(invalid="ignore"):
+            result = np.multiply(log_tp, p)
+        if p == 0.0:
+            # 0 ** 0 is 1, but 0 * log(0) is nan
+            result[np.isnan(result)] = 0.0
+        np.exp(result, out=result)
+        result /= result.sum(1)[:, np.newaxis]
+        result.flags.writeable = False
+    return _memo_put(_uniformified, tp, p, result)
+
+def _warm_solve(A, b, x0, tol=1e-12):
+    """Solve Ax = b by GMRES, starting from x0 (eg the solution for a
+    nearby A). A direct solve if there's no x0 or GMRES fails."""
+    if x0 is not None:
+        x, info = scipy.sparse.linalg.gmres(A, b, x0=x0, tol=tol, atol=tol * np.abs(b).max(),
+                                            restart=50, maxiter=1000)
+        if info == 0:
+            return x
+    return np.linalg.solve(A, b)
+
+# The matrix being swept, shared with worker processes
+_sweep_tp = None
+
+def _uniformify_sweep_chunk(args):
+    """Steady state, MFPT and mu_sigma of uniformify(_sweep_tp, p) for
+    each p in ps, in order. We use A = I - P + 1w' with w uniform:
+    then pi' = w' inv(A), and with G = inv(A), MFPT m_ij = (G_jj -
+    G_ij) / pi_j. If targets are given, only the MFPTs to them are
+    needed, and they and the steady state are found by iterative
+    solves, each warm-started from the solution for the previous p."""
+    ps, targets = args
+    tp = _sweep_tp
+    n = len(tp)
+    w = np.ones(n) / n
+    ss = None
+    cols = [None] * len(targets or [])
+    results = []
+    for p in ps:
+        P = uniformify(tp, p)
+        A = np.eye(n) - P + w[np.newaxis, :]
+        if targets is None:
+            G = np.linalg.inv(A)
+            ss = w.dot(G)
+            mfpt = (np.diag(G)[np.newaxis, :] - G) / ss[np.newaxis, :]
+            set_self_transition_zero(mfpt)
+        else:
+            ss = _warm_solve(A.T, w, ss)
+            for k, j in enumerate(targets):
+                # m_i = 1 + sum_l P_il m_l for i != j, m_j = 0
+                Q = np.array(P)
+                Q[:, j] = 0.0
+                Q[j, :] = 0.0
+                b = np.ones(n)
+                b[j] = 0.0
+                cols[k] = _warm_solve(np.eye(n) - Q, b, cols[k])
+            mfpt = np.array(cols).T
+        results.append((p, (ss, mfpt, mu_sigma(P))))
+    return results
+
+def uniformify_sweep(tp, ps, targets=None, nprocs=None, min_run=4):
+    """For each p in ps, calculate the steady state, MFPT and mu_sigma
+    of uniformify(tp, p), as get_steady_state, get_mfpt and mu_sigma
+    would. If targets (a list of states) is given, only the MFPT
+    columns for those targets are calculated, iteratively, with each
+    solve warm-started from the previous p's solution, since adjacent
+    values of p give similar chains. The sweep is split into
+    contiguous chunks which run in parallel. Warm starts only happen
+    within a chunk, so with targets each chunk gets a run of at least
+    min_run values of p (if there are that many), whatever nprocs
+    is. Returns an OrderedDict mapping p to (steady state, MFPT,
+    mu_sigma)."""
+    global _sweep_tp
+    tp = np.asarray(tp, dtype=float)
+    ps = list(ps)
+    if nprocs is None:
+        nprocs = multiprocessing.cpu_count()
+    nchunks = min(nprocs, len(ps))
+    if targets is not None:
+        nchunks = min(nchunks, max(1, len(ps) // min_run))
+    chunks = [(list(c), targets) for c in np.array_split(ps, nchunks) if len(c)]
+    # must be set before the pool forks
+    _sweep_tp = tp
+    try:
+        if nprocs == 1 or len(chunks) < 2:
+            chunk_results = map(_uniformify_sweep_chunk, chunks)
+        else:
+            pool = multiprocessing.Pool(len(chunks))
+            try:
+                chunk_results = pool.map(_uniformify_sweep_chunk, chunks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        _sweep_tp = None
+    return OrderedDict(item for chunk in chunk_results for item in chunk)
 
 def land_of_oz_matrix():
     """From Kemeny & Snell 1976. The states are rain, nice and
@@ -588,8 +1119,9 @@ def SP_v_MFPT_example_matrices():
 
 def permute_vals(v, k):
     """v is a list of values. We permute by swapping pairs, k times.
-    We copy v first, to avoid mutating the original."""
-    v = v[:]
+    We copy v first, to avoid mutating the original. (Slicing a NumPy
+    array would give a view, not a copy.)"""
+    v = list(v)
     L = len(v)
     for x in range(k):
         i, j = random.randint(0, L-1), random.randint(0, L-1)
@@ -598,9 +1130,24 @@ def permute_vals(v, k):
 
 def mu_sigma(t):
     """Calculate mean(stddev_1(t)) and stddev(stddev_1(t)), ie the
-    mean of row stddevs and the stddev of row stddevs."""
-    sigma = np.std(t, 1)
-    return np.mean(sigma), np.std(sigma)
+    mean of row stddevs and the stddev of row stddevs. Memoised, like
+    uniformify, and t may be a scipy.sparse matrix or a structured
+    operator."""
+    if hasattr(t, "mu_sigma"):
+        return t.mu_sigma()
+    sparse = scipy.sparse.issparse(t)
+    result = _memo_get(_mu_sigma, t)
+    if result is not None:
+        return result
+    if sparse:
+        # var = E[x^2] - E[x]^2, over all entries including zeros
+        n = t.shape[1]
+        mean = np.asarray(t.sum(1)).ravel() / n
+        sq = np.asarray(t.multiply(t).sum(1)).ravel() / n
+        sigma = np.sqrt(np.maximum(sq - mean**2, 0.0))
+    else:
+        sigma = np.std(t, 1)
+    return _memo_put(_mu_sigma, t, None, (np.mean(sigma), np.std(sigma)))
 
 def gini_coeff(x):
     """A measure of inequality in a distribution. From
@@ -612,6 +1159,20 @@ def gini_coeff(x):
     r = np.argsort(np.argsort(-x)) # calculates zero-based ranks
     return 1 - (2.0 * (r*x).sum() + s)/(n*s)
 
+def reversible_chain(tp, k=None):
+    """If tp has detailed balance, return a markov.ReversibleChain for
+    it (top k eigenpairs only, if k is given), else None. It's a
+    snapshot of tp: pass it to get_mfpt, MSTP_max_n_steps etc. to
+    share one eigendecomposition between them, and make a new one if
+    tp changes. Structured operators and scipy.sparse matrices (unless
+    k is given) return None."""
+    if hasattr(tp, "mfpt") or (scipy.sparse.issparse(tp) and k is None):
+        return None
+    try:
+        return markov.ReversibleChain(tp, k=k)
+    except (ValueError, np.linalg.LinAlgError):
+        return None
+
 def detailed_balance(tp, s=None):
     """Calculate whether a given chain has the detailed balance
     condition, that is given a transition matrix tp, with stationary
@@ -627,38 +1188,57 @@ def detailed_balance(tp, s=None):
 # TSP stuff
 ###################################################################
 
-def two_opt(p):
+def two_opt(p, move=None):
     """2-opt means choosing any two non-contiguous edges ab and cd,
     chopping them, and then reconnecting (such that the result is
     still a complete tour). There are actually two ways of doing it --
-    one is the identity, and one gives a new tour."""
+    one is the identity, and one gives a new tour. The move (i, j) is
+    chosen at random unless given (see two_opt_moves)."""
     n = len(p)
-    i = random.randint(0, n)
-    j = None
-    while j == None or abs(i - j) <= 1 or abs(i - j) == n:
-        j = random.randint(0, n)
+    if move is None:
+        i = random.randint(0, n)
+        j = None
+        while j == None or abs(i - j) <= 1 or abs(i - j) == n:
+            j = random.randint(0, n)
+    else:
+        i, j = move
     i, j = min(i, j), max(i, j)
     sol = p[:i+1] + p[j:i:-1] + p[j+1:]
     return canonicalise(sol)
 
-def three_opt(p, broad=False):
+def two_opt_moves(n):
+    """All the moves (i, j) two_opt can choose for a tour of length n,
+    with the probability of each: i is uniform, then j is uniform
+    among the values allowed for that i."""
+    result = []
+    for i in range(n+1):
+        js = [j for j in range(n+1) if abs(i - j) > 1 and abs(i - j) != n]
+        for j in js:
+            result.append(((i, j), 1.0 / ((n+1) * len(js))))
+    return result
+
+def three_opt(p, broad=False, move=None):
     """In the broad sense, 3-opt means choosing any three edges ab, cd
     and ef and chopping them, and then reconnecting (such that the
     result is still a complete tour). There are eight ways of doing
     it. One is the identity, 3 are 2-opt moves (because either ab, cd,
     or ef is reconnected), and 4 are 3-opt moves (in the narrower
-    sense)."""
+    sense). The move (a, c, e, which) is chosen at random unless given
+    (see three_opt_moves)."""
     n = len(p)
-    # choose 3 unique edges defined by their first node
-    a, c, e = random.sample(range(n+1), 3)
-    # without loss of generality, sort
-    a, c, e = sorted([a, c, e])
-    b, d, f = a+1, c+1, e+1
-
-    if broad == True:
-        which = random.randint(0, 7) # allow any of the 8
+    if move is None:
+        # choose 3 unique edges defined by their first node
+        a, c, e = random.sample(range(n+1), 3)
+        # without loss of generality, sort
+        a, c, e = sorted([a, c, e])
+
+        if broad == True:
+            which = random.randint(0, 7) # allow any of the 8
+        else:
+            which = random.choice([3, 4, 5, 6]) # allow only strict 3-opt
     else:
-        which = random.choice([3, 4, 5, 6]) # allow only strict 3-opt
+        a, c, e, which = move
+    b, d, f = a+1, c+1, e+1
         
     # in the following slices, the nodes abcdef are referred to by
     # name. x:y:-1 means step backwards. anything like c+1 or d-1
@@ -683,6 +1263,14 @@ def three_opt(p, broad=False):
         
     return canonicalise(sol)
 
+def three_opt_moves(n, broad=False):
+    """All the moves (a, c, e, which) three_opt can choose for a tour
+    of length n, with the probability of each."""
+    whiches = range(8) if broad else [3, 4, 5, 6]
+    edges = list(itertools.combinations(range(n+1), 3))
+    prob = 1.0 / (len(edges) * len(whiches))
+    return [((a, c, e, which), prob) for a, c, e in edges for which in whiches]
+
 def canonicalise(p):
     """In any TSP, 01234 is equivalent to 23410. We canonicalise on
     the former. In a symmetric TSP, 01234 is equivalent to 04321. We
@@ -703,6 +1291,49 @@ def tsp_tours(n):
         if p[1] > p[-1]: continue
         yield p
 
+def _count_canonical_completions(first, rest, last=None):
+    """How many ways to arrange the values in rest after a tour
+    prefix starting with first, such that the tour's last city is
+    greater than first (tsp_tours's canonical direction). If rest is
+    empty, last is the final city of the prefix."""
+    if not rest:
+        return 1 if last > first else 0
+    return sum(1 for x in rest if x > first) * math.factorial(len(rest) - 1)
+
+def tsp_tour_rank(p):
+    """The index of canonical tour p in tsp_tours(len(p)), without
+    enumerating. Tours start with 0, then are in lexicographic order
+    among those with p[1] < p[-1]."""
+    p = list(p)
+    rest = sorted(p[1:])
+    rank = 0
+    for k in range(1, len(p)):
+        for c in rest:
+            if c == p[k]:
+                break
+            others = [x for x in rest if x != c]
+            first = c if k == 1 else p[1]
+            rank += _count_canonical_completions(first, others, c)
+        rest.remove(p[k])
+    return rank
+
+def tsp_tour_unrank(i, n):
+    """The tour with index i in tsp_tours(n). Inverse of
+    tsp_tour_rank."""
+    p = [0]
+    rest = range(1, n)
+    for k in range(1, n):
+        for c in rest:
+            others = [x for x in rest if x != c]
+            first = c if k == 1 else p[1]
+            count = _count_canonical_completions(first, others, c)
+            if i < count:
+                break
+            i -= count
+        p.append(c)
+        rest.remove(c)
+    return tuple(p)
+
 def sample_transitions(n, opt=2, nsamples=10000):
     length = len(list(tsp_tours(n)))
     tm = np.zeros((length, length))
@@ -723,6 +1354,27 @@ def sample_transitions(n, opt=2, nsamples=10000):
             tm[i][tours_to_ints[tuple(t)]] += delta
     return tm
 
+# A few arbitrary cities, as used for the SIGEvo images. The first n
+# are used for a TSP of size n.
+sigevo_cities = np.array([[0, 0],
+                          [10, 1],
+                          [5, 5],
+                          [2, 8],
+                          [8, 9],
+                          [5, 9],
+                          [7, 1]], dtype=float)
+
+def tsp_fitvals(n, coords=None):
+    """Tour length of every tour of n cities, in tsp_tours order. The
+    coordinates of all tours' cities are looked up in one go, and the
+    lengths of the closing legs included."""
+    if coords is None:
+        coords = sigevo_cities[:n]
+    tours = np.array(list(tsp_tours(n)))
+    c = coords[tours]
+    legs = c - np.roll(c, -1, axis=1)
+    return np.sqrt((legs**2).sum(axis=2)).sum(axis=1)
+
 def kendall_tau_permutation_distance(t1, t2):
     corr, p = scipy.stats.kendalltau(t1, t2)
     return 1.0 - corr